@@ -19,24 +19,44 @@ import io
 
 from . import cd
 from . import data
+from . import glyph
 from . import text
 from . import map
+from . import flow
+from . import asm
+from . import exe
 from . import archive
+from . import cache
+from . import manifest
+from . import stage
 from . import lzss
 from .version import Version
 
 
 # Object representing a CD image of the game.
+#
+# Like GameDirectory, it holds settings which the tools share between all
+# code working on the game:
+#   codec    = wa.text.Codec object for the text of the game, or None
+#   mapCache = wa.cache.ScriptCache for parsed map data, or None
 class GameImage(cd.Image):
     def __init__(self, imagePath):
         cd.Image.__init__(self, imagePath)
 
+        self.codec = None
+        self.mapCache = None
+
     # Retrieve a file from the image, returning an open file object.
     def openFile(self, subDir, fileName):
         data = self.readFile(subDir + '/' + fileName)
         f = io.BytesIO(data)
         return f
 
+    # Read part of a file from the image, returning the data as a byte
+    # string.
+    def readFilePart(self, subDir, fileName, offset, numBytes):
+        return self.readFileRange(subDir + '/' + fileName, offset, numBytes)
+
     # Check for the existence of a file in the image.
     def hasFile(self, subDir, fileName):
         try:
@@ -46,16 +66,38 @@ class GameImage(cd.Image):
             return False
 
 
-# Object representing a directory of the game's files.
+# Object representing a directory of the game's files. It holds the same
+# 'codec' and 'mapCache' settings as GameImage.
 class GameDirectory:
     def __init__(self, dirPath):
         self.basePath = dirPath
 
+        self.codec = None
+        self.mapCache = None
+
     # Retrieve a file from the directory, returning an open file object.
     def openFile(self, subDir, fileName):
         filePath = os.path.join(self.basePath, subDir, fileName)
         return open(filePath, "rb")
 
+    # Read part of a file from the directory, returning the data as a byte
+    # string.
+    def readFilePart(self, subDir, fileName, offset, numBytes):
+        f = self.openFile(subDir, fileName)
+        f.seek(offset)
+        data = f.read(numBytes)
+        f.close()
+
+        if len(data) < numBytes:
+            raise ValueError("Attempt to read beyond end of file '%s'" % fileName)
+
+        return data
+
+    # Reopen the open files of the object in a process created by fork().
+    # Files in a directory are opened on demand, so nothing needs to be done.
+    def reopen(self):
+        pass
+
     # Check for the existence of a file in the directory.
     def hasFile(self, subDir, fileName):
         filePath = os.path.join(self.basePath, subDir, fileName)
@@ -0,0 +1,501 @@
+#
+# wa.asm - Wild Arms script listings and assembler
+#
+# Copyright (C) Christian Bauer <www.cebix.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+
+import hashlib
+import json
+import re
+import struct
+
+from wa.map import Op, Instruction, opcodes, exOpcodes, scanInstruction
+
+
+#
+# A listing is the disassembly of the scripts of a map as created by the
+# 'mapinfo' tool. It consists of the two script sections, each of which is
+# introduced by a "# Script 1" or "# Script 2" header, and contains lines of
+# the form
+#
+#   <addr>: <instruction>
+#
+# Entry points are marked by "Entry" lines, which divide the sections into
+# chunks. Lines starting with "#" or ";" are comments. Instructions inserted
+# into a listing may be written without an address, indented by white space.
+#
+# The assembler turns a listing back into lists of Instruction objects. To
+# keep the reassembly of an edited listing fast, and the binary code of
+# unchanged parts identical, the instructions of each chunk are stored in
+# an index under a hash of the text of the chunk, and only chunks whose text
+# is not found in the index are assembled.
+#
+
+indexFormatVersion = 1
+
+_instrPattern = re.compile(r"([0-9a-f]{4}): (.*)$")
+_newInstrPattern = re.compile(r"\s+(\S.*)$")
+_sectionPattern = re.compile(r"# Script ([12])$")
+
+
+# Disassemble the scripts of a map, returning a list of lines in the
+# listing format. The scripts are extracted if they are not given.
+def formatListing(mapData, script1 = None, script2 = None):
+    if script1 is None:
+        script1 = mapData.getScript1()
+    if script2 is None:
+        script2 = mapData.getScript2()
+
+    lines = []
+
+    # Index the entry points and cross-references
+    entryIndex = mapData.getEntryIndex()
+    xrefs = mapData.getXrefs(script1, script2)
+
+    for scriptName, script in [("Script 1", script1), ("Script 2", script2)]:
+        lines.append("#")
+        lines.append("# " + scriptName)
+        lines.append("#")
+        lines.append("")
+
+        prevLineEmpty = False
+
+        for instr in script:
+
+            # Label entry points and instructions referred to by others
+            labels = ["Entry %d.%d:" % entry for entry in entryIndex.get(instr.addr, [])]
+
+            if instr.addr in xrefs:
+                labels.append("; from " + ", ".join("%s %04x" % (kind, addr) for addr, kind in xrefs[instr.addr]))
+
+            if labels:
+                if not prevLineEmpty:
+                    lines.append("")
+
+                lines.extend(labels)
+                lines.append("")
+                prevLineEmpty = False
+
+            lines.append("%04x: %s" % (instr.addr, instr.disass))
+
+            if instr.op in [Op.RETURN, Op.PTR]:
+                lines.append("")
+                prevLineEmpty = True
+
+    return lines
+
+
+# Object representing a chunk of a listing: the instruction lines from one
+# entry point up to the next one.
+#
+# Attributes:
+#   lines = list of (lineNumber, addr, text) tuples of the instructions,
+#           where 'addr' is None for instructions without an address
+#   hash  = hash of the text of the instruction lines (hex string)
+class Chunk:
+    __slots__ = ("lines", "hash")
+
+    def __init__(self):
+        self.lines = []
+        self.hash = None
+
+
+# Split a listing, given as a list of lines, into the two script sections.
+# Returns a list of two lists of Chunk objects.
+def splitListing(lines):
+    sections = [[], []]
+    section = None
+    newChunk = True
+
+    h = None
+
+    for lineNumber, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+
+        m = _sectionPattern.match(line)
+        if m:
+            section = sections[int(m.group(1)) - 1]
+            newChunk = True
+            continue
+
+        if not line.strip() or line.startswith("#") or line.startswith(";"):
+            continue
+
+        if line.startswith("Entry "):
+            newChunk = True
+            continue
+
+        m = _instrPattern.match(line)
+        if m:
+            addr, text = int(m.group(1), 16), m.group(2)
+        else:
+            m = _newInstrPattern.match(line)
+            if not m:
+                raise ValueError("Line %d: Syntax error" % lineNumber)
+
+            addr, text = None, m.group(1)
+
+        if section is None:
+            raise ValueError("Line %d: Instruction outside of script section" % lineNumber)
+
+        if newChunk:
+            chunk = Chunk()
+            section.append(chunk)
+            h = hashlib.sha1()
+            newChunk = False
+
+        chunk.lines.append((lineNumber, addr, text))
+
+        h.update(line.encode("utf-8") + b"\n")
+        chunk.hash = h.hexdigest()
+
+    return sections
+
+
+# Create an index of the chunks of a listing which was created from the given
+# scripts by formatListing(), returning a dictionary of chunk hash to list of
+# Instruction objects.
+def indexListing(lines, script1, script2):
+    index = {}
+
+    for section, script in zip(splitListing(lines), [script1, script2]):
+        i = 0
+        for chunk in section:
+            index[chunk.hash] = script[i:i + len(chunk.lines)]
+            i += len(chunk.lines)
+
+    return index
+
+
+# Return the hash of a map data block, which identifies the data an index
+# file belongs to.
+def getDataHash(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+# Load a chunk index from a file, returning a dictionary of chunk hash to
+# list of Instruction objects. Returns None if the file does not exist or
+# does not belong to the map data with the given hash.
+def loadIndex(filePath, dataHash):
+    try:
+        with open(filePath, "r", encoding = "ascii") as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if index.get("format") != indexFormatVersion or index.get("data") != dataHash:
+        return None
+
+    return {h: [Instruction(op, len(bytes.fromhex(data)), addr, bytes.fromhex(data), None, tuple(reloc)) for op, addr, data, reloc in instrs]
+            for h, instrs in index["chunks"].items()}
+
+
+# Save a chunk index to a file, given the hash of the map data it belongs to.
+def saveIndex(filePath, dataHash, index):
+    chunks = {h: [(instr.op, instr.addr, instr.bytes.hex(), instr.reloc) for instr in instrs] for h, instrs in index.items()}
+
+    with open(filePath, "w", encoding = "ascii") as f:
+        json.dump({"format": indexFormatVersion, "data": dataHash, "chunks": chunks}, f)
+
+
+#
+# Expression assembler
+#
+# Expressions are written fully parenthesized, in the form created by
+# wa.map.Expression.format(). As the disassembly of the unary "== 0"
+# operator is identical to a comparison with the value 0, "(x == 0)" is
+# always assembled to the shorter unary form.
+#
+
+_binaryOps = {exOpcodes[op]: op for op in range(0x0f) if op != 0x09}
+_variables = {exOpcodes[op]: op for op in range(0x11, len(exOpcodes)) if exOpcodes[op] and op != 0x15}
+_simpleVariables = [0x11, 0x12, 0x20, 0x21]
+
+_tokenPattern = re.compile(r"\(|\)|\[|\]|[^\s()\[\]]+")
+_intPattern = re.compile(r"-?\d+$")
+
+
+class _ExpressionAssembler:
+    def __init__(self, text):
+        self.tokens = _tokenPattern.findall(text)
+        self.pos = 0
+        self.data = bytearray()
+
+    def _peek(self, ahead = 0):
+        if self.pos + ahead < len(self.tokens):
+            return self.tokens[self.pos + ahead]
+        else:
+            return None
+
+    def _next(self):
+        token = self._peek()
+        if token is None:
+            raise ValueError("Unexpected end of expression")
+
+        self.pos += 1
+        return token
+
+    def _expect(self, token):
+        if self._next() != token:
+            raise ValueError("Expected '%s' in expression" % token)
+
+    # Assemble the expression, returning the binary data.
+    def assemble(self, assignment):
+        self._operand(assignment)
+
+        if self.pos < len(self.tokens):
+            raise ValueError("Unexpected '%s' in expression" % self.tokens[self.pos])
+
+        return self.data
+
+    def _operand(self, assignment = False):
+        token = self._peek()
+
+        if token == "(":
+            self._next()
+
+            if self._peek() == "addr":
+
+                # Script address
+                self._next()
+                self.data.append(0x15)
+                self.data += struct.pack("<H", int(self._next(), 16))
+                self._expect(")")
+                return
+
+            # Operator; the opcode precedes the operands
+            opOffset = len(self.data)
+            self.data.append(0)
+
+            self._operand()
+
+            token = self._next()
+
+            if token == "==" and self._peek() == "0" and self._peek(1) == ")":
+
+                # Unary operator
+                self.pos += 2
+                self.data[opOffset] = 0x09
+                return
+
+            if token not in _binaryOps:
+                raise ValueError("Invalid operator '%s' in expression" % token)
+
+            self.data[opOffset] = _binaryOps[token]
+
+            self._operand()
+            self._expect(")")
+
+        elif token is not None and _intPattern.match(token):
+
+            # Immediate value
+            self._next()
+            value = int(token)
+
+            if value < -0x8000 or value > 0x7fff:
+                raise ValueError("Value %d out of range in expression" % value)
+
+            self.data.append(0x10)
+            self.data += struct.pack("<h", value)
+
+        else:
+
+            # Variable
+            token = self._next()
+            if token not in _variables:
+                raise ValueError("Unknown variable '%s' in expression" % token)
+
+            op = _variables[token]
+            self.data.append(op)
+
+            if op not in _simpleVariables:
+                self._expect("[")
+                self._operand()
+                self._expect("]")
+
+            if assignment and op not in [0x12, 0x20]:
+                self._expect("=")
+                self._operand()
+
+
+# Assemble an expression, returning the binary data.
+def assembleExpression(text, assignment = False):
+    return _ExpressionAssembler(text).assemble(assignment)
+
+
+#
+# Instruction assembler
+#
+# Each function takes the operand text of an instruction and returns the
+# binary data of the operands. Opcodes without an assembler take their
+# operand bytes in hex.
+#
+
+def _hexData(text):
+    return bytes(int(x, 16) for x in text.split())
+
+def _assembleTarget(text, codec):
+    return struct.pack("<H", int(text, 16))
+
+_windowPattern = re.compile(r"(\d+)(?: type (\d+), x/y = \((\d+), (\d+)\), w/h = \((\d+), (\d+)\))?$")
+
+def _assembleWindow(text, codec):
+    m = _windowPattern.match(text)
+    if not m:
+        raise ValueError("Invalid window operands")
+
+    data = bytes([int(m.group(1))])
+    if m.group(2) is not None:
+        data += struct.pack("<5H", *[int(x) for x in m.groups()[1:]])
+
+    return data
+
+def _assembleMessage(text, codec):
+    return bytes(codec.encode(text))
+
+def _assembleAssign(text, codec):
+    return assembleExpression(text, True)
+
+_conditionPattern = re.compile(r"(.*): \(else jump ([0-9a-f]+)\)$")
+
+def _assembleCondition(text, codec):
+    m = _conditionPattern.match(text)
+    if not m:
+        raise ValueError("Invalid condition operands")
+
+    return assembleExpression(m.group(1)) + struct.pack("<H", int(m.group(2), 16))
+
+_menuPattern = re.compile(r"(0x[0-9a-f]+)(?: \([^)]*\))?(.*)$")
+
+def _assembleMenu(text, codec):
+    m = _menuPattern.match(text)
+    if not m:
+        raise ValueError("Invalid menu operands")
+
+    return bytes([int(m.group(1), 16)]) + _hexData(m.group(2))
+
+def _assembleExec(text, codec):
+    return struct.pack("<L", int(text, 16))
+
+_timerPattern = re.compile(r"(\d+):(\d+) (\d+):(\d+) call ([0-9a-f]+)$")
+
+def _assembleTimer(text, codec):
+    m = _timerPattern.match(text)
+    if not m:
+        raise ValueError("Invalid timer operands")
+
+    return struct.pack("<5H", *([int(x) for x in m.groups()[:4]] + [int(m.group(5), 16)]))
+
+_assemblers = {
+    Op.MESSAGE: _assembleMessage,
+    Op.CALL:    _assembleTarget,
+    Op.JUMP:    _assembleTarget,
+    Op.BREAK:   _assembleTarget,
+    Op.WINDOW:  _assembleWindow,
+    Op.ASSIGN:  _assembleAssign,
+    Op.IF:      _assembleCondition,
+    Op.WHILE:   _assembleCondition,
+    Op.MENU:    _assembleMenu,
+    Op.EXEC:    _assembleExec,
+    Op.TIMER:   _assembleTimer,
+}
+
+# Mapping of mnemonics to opcodes
+_mnemonics = {mnemonic: op for op, (length, mnemonic) in enumerate(opcodes)}
+
+
+# Assemble one instruction at the given address, returning an Instruction
+# object. The codec is used for encoding text.
+def assembleInstruction(text, addr, codec):
+    mnemonic, sep, operands = text.partition(" ")
+
+    if mnemonic == "entry":
+        return Instruction(Op.ENTRY, 2, addr, struct.pack("<H", int(operands, 16)), None, (0,))
+    elif mnemonic == "string":
+        data = bytes(codec.encode(operands))
+        return Instruction(Op.STRING, len(data), addr, data, None, (), codec.version)
+    elif mnemonic == "<PTR>":
+        return Instruction(Op.PTR, 4, addr, bytes(4))
+
+    if mnemonic not in _mnemonics:
+        raise ValueError("Unknown instruction '%s'" % mnemonic)
+
+    op = _mnemonics[mnemonic]
+
+    if op in _assemblers:
+        data = bytes([op]) + _assemblers[op](operands, codec)
+    else:
+        data = bytes([op]) + _hexData(operands)
+
+    # Check the operands by decoding the structure of the instruction
+    try:
+        length, reloc = scanInstruction(data, 0)
+    except (IndexError, ValueError, struct.error):
+        length, reloc = None, ()
+
+    if length != len(data):
+        raise ValueError("Invalid operands for instruction '%s'" % mnemonic)
+
+    return Instruction(op, length, addr, data, None, reloc, codec.version)
+
+
+# Assemble a listing, given as a list of lines, into the tuple (script1,
+# script2, numAssembled) with the lists of Instruction objects of the two
+# script sections and the number of chunks which had to be assembled.
+# Chunks found in the index (a dictionary of chunk hash to list of
+# Instruction objects) are taken from there. The codec is used for encoding
+# text. Instructions without an address get addresses which are neither
+# used in the listing nor contained in 'reservedAddrs', which should be the
+# addresses in the script entry table.
+def assembleListing(lines, index, codec, reservedAddrs = ()):
+    sections = splitListing(lines)
+
+    usedAddrs = {addr for section in sections for chunk in section for lineNumber, addr, text in chunk.lines}
+    usedAddrs.update(reservedAddrs)
+    usedAddrs.add(0xfffe)  # special CALL target
+
+    freeAddrs = (addr for addr in range(0x10000) if addr not in usedAddrs)
+
+    scripts = []
+    numAssembled = 0
+
+    for section in sections:
+        script = []
+
+        for chunk in section:
+            if chunk.hash in index:
+                script += [Instruction(instr.op, instr.length, instr.addr, instr.bytes, None, instr.reloc, codec.version) for instr in index[chunk.hash]]
+                continue
+
+            for lineNumber, addr, text in chunk.lines:
+                if addr is None:
+                    addr = next(freeAddrs)
+
+                try:
+                    script.append(assembleInstruction(text, addr, codec))
+                except (ValueError, EnvironmentError) as e:
+                    raise ValueError("Line %d: %s" % (lineNumber, e))
+
+            numAssembled += 1
+
+        scripts.append(script)
+
+    script1, script2 = scripts
+
+    if not script1:
+        raise ValueError("Listing contains no script code")
+
+    # Check that all referenced addresses exist
+    addrs = {instr.addr for instr in script1 + script2}
+
+    for instr in script1 + script2:
+        for offset in instr.reloc:
+            target = struct.unpack_from("<H", instr.bytes, offset)[0]
+            if target not in addrs:
+                raise ValueError("Address %04x referenced by instruction at %04x not found" % (target, instr.addr))
+
+    return script1, script2, numAssembled
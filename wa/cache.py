@@ -0,0 +1,219 @@
+#
+# wa.cache - Persistent cache of parsed map data
+#
+# Copyright (C) Christian Bauer <www.cebix.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+
+import array
+import hashlib
+import os
+import struct
+import sys
+
+import wa
+
+
+def _enum(**enums):
+    return type('Enum', (), enums)
+
+
+#
+# The cache stores the results of parsing a map data block which only depend
+# on the data itself: the structure of the script instructions, the location
+# of the MIPS code, and the relocation sites within the code. Each map data
+# block gets one cache file, named after a hash of the data, the map number,
+# the game version, and the versions of the package and the file format.
+#
+# A cache file consists of a header followed by a sequence of records:
+#
+#   header: magic (8 bytes), format version (32 bits)
+#   record: type (8 bits), payload length (32 bits), payload
+#
+# All values are little-endian. Script records contain the instructions in
+# struct-of-arrays form so they can be loaded with few large reads.
+#
+
+cacheMagic = b"WACACHE\0"
+cacheFormatVersion = 1
+
+# Record types
+Record = _enum(
+    SCRIPT     = 1,  # script section: offset, firstInstr, endOffset, instruction structure
+    MIPS_CODE  = 2,  # MIPS code: startOffset, endOffset
+    MIPS_RELOC = 3,  # relocation sites in the MIPS code
+)
+
+_headerFormat = "<8sL"
+_recordFormat = "<BL"
+
+
+# Convert an array to little-endian bytes.
+def _arrayBytes(a):
+    if sys.byteorder != "little":
+        a = array.array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+# Read an array of the given type and number of items from data at the
+# given offset, returning the tuple (array, newOffset).
+def _readArray(typecode, count, data, offset):
+    a = array.array(typecode)
+    end = offset + count * a.itemsize
+    a.frombytes(data[offset:end])
+    if sys.byteorder != "little":
+        a.byteswap()
+    return a, end
+
+
+# Encode a script record given the list of (op, length, reloc) tuples of its
+# instructions.
+def encodeScript(offset, firstInstr, endOffset, instrs):
+    ops = array.array("H", [op for op, length, reloc in instrs])
+    lengths = array.array("H", [length for op, length, reloc in instrs])
+    counts = array.array("B", [len(reloc) for op, length, reloc in instrs])
+    relocs = array.array("H", [x for op, length, reloc in instrs for x in reloc])
+
+    return struct.pack("<5L", offset, firstInstr, endOffset, len(instrs), len(relocs)) + \
+           _arrayBytes(ops) + _arrayBytes(lengths) + _arrayBytes(counts) + _arrayBytes(relocs)
+
+
+# Decode a script record, returning the tuple (offset, firstInstr,
+# endOffset, instrs).
+def decodeScript(payload):
+    offset, firstInstr, endOffset, numInstrs, numRelocs = struct.unpack_from("<5L", payload)
+
+    pos = struct.calcsize("<5L")
+    ops, pos = _readArray("H", numInstrs, payload, pos)
+    lengths, pos = _readArray("H", numInstrs, payload, pos)
+    counts, pos = _readArray("B", numInstrs, payload, pos)
+    relocs, pos = _readArray("H", numRelocs, payload, pos)
+
+    # Share the relocation tuples between instructions
+    relocTuples = {}
+
+    instrs = []
+    r = 0
+    for op, length, count in zip(ops, lengths, counts):
+        if count:
+            reloc = tuple(relocs[r:r + count])
+            reloc = relocTuples.setdefault(reloc, reloc)
+            r += count
+        else:
+            reloc = ()
+
+        instrs.append((op, length, reloc))
+
+    return offset, firstInstr, endOffset, instrs
+
+
+# Encode a MIPS relocation record given the list of (index, type, pointer)
+# tuples returned by wa.map.findMipsRelocs().
+def encodeMipsRelocs(relocs):
+    indexes = array.array("I", [i for i, relocType, p in relocs])
+    types = array.array("B", [relocType for i, relocType, p in relocs])
+    pointers = array.array("I", [p or 0 for i, relocType, p in relocs])
+
+    return struct.pack("<L", len(relocs)) + _arrayBytes(indexes) + _arrayBytes(types) + _arrayBytes(pointers)
+
+
+# Decode a MIPS relocation record, returning a list of (index, type,
+# pointer) tuples.
+def decodeMipsRelocs(payload):
+    count = struct.unpack_from("<L", payload)[0]
+
+    pos = 4
+    indexes, pos = _readArray("I", count, payload, pos)
+    types, pos = _readArray("B", count, payload, pos)
+    pointers, pos = _readArray("I", count, payload, pos)
+
+    return [(i, relocType, p if p else None) for i, relocType, p in zip(indexes, types, pointers)]
+
+
+# Persistent cache of parsed map data in a directory.
+class ScriptCache:
+
+    # Create a cache object for the given directory, creating it if
+    # necessary.
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    # Return the cache key for a map data block as a hex string.
+    def getKey(self, data, mapNumber, version):
+        h = hashlib.sha1()
+        h.update(struct.pack("<LLL", cacheFormatVersion, mapNumber, version))
+        h.update(wa.__version__.encode("ascii"))
+        h.update(data)
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cacheDir, key + ".bin")
+
+    # Load the records for a key, returning a dictionary of record type to
+    # list of payloads. Missing or invalid cache files yield an empty
+    # dictionary.
+    def load(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except OSError:
+            return {}
+
+        headerSize = struct.calcsize(_headerFormat)
+        recordSize = struct.calcsize(_recordFormat)
+
+        if len(data) < headerSize:
+            return {}
+
+        magic, formatVersion = struct.unpack_from(_headerFormat, data)
+        if magic != cacheMagic or formatVersion != cacheFormatVersion:
+            return {}
+
+        records = {}
+
+        offset = headerSize
+        while offset + recordSize <= len(data):
+            recordType, size = struct.unpack_from(_recordFormat, data, offset)
+            offset += recordSize
+
+            if offset + size > len(data):
+                return {}  # truncated file
+
+            records.setdefault(recordType, []).append(data[offset:offset + size])
+            offset += size
+
+        return records
+
+    # Store the records for a key, given a dictionary of record type to
+    # list of payloads. The file is replaced atomically, so concurrent
+    # readers never see a partial file.
+    def save(self, key, records):
+        data = bytearray(struct.pack(_headerFormat, cacheMagic, cacheFormatVersion))
+
+        for recordType in sorted(records):
+            for payload in records[recordType]:
+                data += struct.pack(_recordFormat, recordType, len(payload))
+                data += payload
+
+        path = self._path(key)
+        tmpPath = path + ".%d.tmp" % os.getpid()
+
+        try:
+            with open(tmpPath, "wb") as f:
+                f.write(data)
+            os.replace(tmpPath, path)
+        except OSError:
+
+            # The cache is only an optimization, so failing to write it is
+            # not an error
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
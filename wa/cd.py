@@ -61,11 +61,18 @@ class Image:
     def close(self):
         self.file.close()
 
+    # Reopen the image file. This gives a process created by fork() its own
+    # file position, independent of the parent process.
+    def reopen(self):
+        self.file = open(self.file.name, "rb")
+
     # Read contiguous data from the image given the start sector and number
-    # of bytes to read. Returns the data as a byte string.
-    def readExtent(self, firstSector, numBytes):
+    # of bytes to read. If an offset is given, reading starts at that byte
+    # offset relative to the start sector. Returns the data as a byte string.
+    def readExtent(self, firstSector, numBytes, offset = 0):
         data = bytearray()
-        sector = firstSector
+        sector = firstSector + offset // 2048
+        skip = offset % 2048
 
         while numBytes > 0:
             self.file.seek(sector * self.blockSize + self.blockOffset)
@@ -76,9 +83,13 @@ class Image:
 
             sector += 1
 
-            if numBytes > 2048:
+            if skip:
+                sectorData = sectorData[skip:]
+                skip = 0
+
+            if numBytes > len(sectorData):
                 data.extend(sectorData)
-                numBytes -= 2048
+                numBytes -= len(sectorData)
             else:
                 data.extend(sectorData[:numBytes])
                 numBytes = 0
@@ -156,3 +167,14 @@ class Image:
     def readFile(self, pathName):
         firstSector, numBytes = self.findExtent(pathName)
         return self.readExtent(firstSector, numBytes)
+
+    # Read part of a file from the image specified by path name, offset, and
+    # number of bytes, returning the data as a byte string. Raises a KeyError
+    # if the file was not found.
+    def readFileRange(self, pathName, offset, numBytes):
+        firstSector, fileSize = self.findExtent(pathName)
+
+        if offset + numBytes > fileSize:
+            raise ValueError("Attempt to read beyond end of file '%s'" % pathName)
+
+        return self.readExtent(firstSector, numBytes, offset)
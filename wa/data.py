@@ -647,6 +647,19 @@ def fontData(version):
         return None
 
 
+# Offset of the Kanji font in the main executable (JP version only), which
+# contains the characters of the global Kanji tables in order
+def kanjiFontOffset(version):
+    if not isJapanese(version):
+        return None
+
+    for offset, numChars, charWidth, charHeight, lineSpacing, outCharsPerRow, transDir, transFileName in fontData(version):
+        if transFileName == "kanji.png":
+            return offset
+
+    return None
+
+
 #
 # Script code in the main executable
 #
@@ -782,3 +795,58 @@ def openingTableOffset(version):
         return 0x2868
     else:
         return 0x21b0
+
+
+#
+# Memory layout of the main executable
+#
+
+# Start address of the heap which the main executable sets up at startup.
+# The memory after the loaded part of the executable is only free up to
+# this address. The heap base has not been determined for any version of
+# the game yet, so this returns None until the addresses are added here.
+def execHeapBase(version):
+    return None
+
+
+#
+# Files used by the stages of the translation tools
+#
+
+# Return the translation files of a map as a list of (subDir, fileName)
+# tuples.
+def mapTransFiles(mapNumber):
+    return [("map", "%03d.txt" % mapNumber), ("map", "%03d_extra.txt" % mapNumber)]
+
+
+# Return the translation files and the game files of the stages which deal
+# with the executable, the overlay, the maps with the given numbers, and the
+# textures, as a dictionary which maps the name of each stage to a tuple
+# (transFiles, gameFiles) of lists of (subDir, fileName) tuples.
+def stageFiles(version, mapNumbers):
+    execTransFiles = [(transDir, transFileName) for *_, transDir, transFileName in execFileData(version)]
+    execTransFiles += [(transDir, transFileName) for *_, transDir, transFileName in execFileData2(version)]
+    execTransFiles += [(transDir, transFileName) for *_, transDir, transFileName in fontData(version)]
+    execTransFiles.append(("exe", "script.txt"))
+
+    utilTransFiles = [(transDir, transFileName) for *_, transDir, transFileName in utilFileData(version)]
+
+    mapFiles = [f for mapNumber in mapNumbers for f in mapTransFiles(mapNumber)]
+
+    textureTransFiles = []
+    textureGameFiles = []
+
+    for subDir, fileName, archiveSize, lastSectionSize, textureList in textureData:
+        textureTransFiles += [("gfx", transFileName) for *_, transFileName in textureList]
+        textureGameFiles.append((subDir, fileName))
+
+    textureTransFiles += [("gfx", transFileName) for clutSize, dimensions, transFileName in openingData(version)[:3]]
+    textureTransFiles += [("gfx", "battle_icons.png"), ("gfx", "battle_icons2.png")]
+    textureGameFiles += [("EXE", "OPENING.EXE"), ("SYS", "OP0.BIN"), ("BIN", "CDFLR.BIN")]
+
+    return {
+        "executable": (execTransFiles, [("EXE", "WILDARMS.EXE")]),
+        "overlay": (utilTransFiles, [("SYS", "UT0.OVR")]),
+        "maps": (mapFiles, [("BIN", "CDSTG.BIN")]),
+        "textures": (textureTransFiles, textureGameFiles),
+    }
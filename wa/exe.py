@@ -0,0 +1,354 @@
+#
+# wa.exe - Access to the data tables of the main executable
+#
+# Copyright (C) Christian Bauer <www.cebix.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+
+import struct
+
+import wa
+from wa.map import Op
+
+
+# Conversion between file offsets and memory addresses
+execBaseAddr = 0x80011420 - 0x800
+
+# PS-X EXE header
+execHeaderSize = 0x800
+execMagic = b"PS-X EXE"
+_headerFormat = "<8s8x10L"
+
+# The size of the loaded part of an executable is a multiple of the CD
+# sector size
+execAlignment = 0x800
+
+
+# Object representing the header of a PS-X EXE file.
+#
+# Attributes:
+#   pc, gp                = initial values of the PC and GP registers
+#   textAddr, textSize    = memory address and size of the part of the file
+#                           following the header which is loaded into RAM
+#   dataAddr, dataSize    = memory address and size of the initialized data
+#                           (unused)
+#   bssAddr, bssSize      = memory address and size of the area which is
+#                           cleared at startup
+#   stackAddr, stackSize  = initial stack pointer and stack size
+class ExecHeader:
+
+    # Parse the header from the data of an executable. Raises ValueError if
+    # the data is not a PS-X EXE file.
+    def __init__(self, data):
+        if len(data) < execHeaderSize:
+            raise ValueError("Executable is too short")
+
+        (magic, self.pc, self.gp, self.textAddr, self.textSize, self.dataAddr, self.dataSize,
+         self.bssAddr, self.bssSize, self.stackAddr, self.stackSize) = struct.unpack_from(_headerFormat, data)
+
+        if magic != execMagic:
+            raise ValueError("Executable is not a PS-X EXE file")
+
+    # Write the header back to the data of an executable.
+    def pack(self, data):
+        struct.pack_into(_headerFormat, data, 0, execMagic, self.pc, self.gp, self.textAddr, self.textSize, self.dataAddr, self.dataSize,
+                         self.bssAddr, self.bssSize, self.stackAddr, self.stackSize)
+
+
+# Object representing the main executable WILDARMS.EXE. The file is read
+# once, and the tables described in wa.data are decoded on first access
+# and then cached, so all users of the executable share the same data.
+#
+# The data may be modified in place if it was given as a bytearray, but
+# the cached tables must then be discarded with invalidate() before they
+# are accessed again.
+class ExecFile:
+
+    # Create an ExecFile object from the binary data of the executable.
+    def __init__(self, data, version):
+        self.data = data
+        self.version = version
+        self.baseAddr = execBaseAddr
+
+        self.invalidate()
+
+    # Discard all cached tables.
+    def invalidate(self):
+        self._pointers = {}
+        self._stringTables = {}
+        self._simpleTables = {}
+        self._mapNames = {}
+        self._scripts = None
+
+    # Convert a memory address to a file offset.
+    def pointerToOffset(self, pointer):
+        return pointer - self.baseAddr
+
+    # Convert a file offset to a memory address.
+    def offsetToPointer(self, offset):
+        return offset + self.baseAddr
+
+    # Parse and return the header of the executable as an ExecHeader object.
+    def getHeader(self):
+        return ExecHeader(self.data)
+
+    # Return the tuple (offset, size) of the space after the end of the
+    # loaded part of the executable which can be used for extending it.
+    # This is the memory between the end of the executable and the area
+    # cleared at startup, the heap, or the area into which the maps are
+    # loaded, whichever comes first. If the header describes no area
+    # cleared at startup and the heap base of the game version is not
+    # known, the free memory can not be determined, and EnvironmentError is
+    # raised.
+    def getExpansionSpace(self):
+        header = self.getHeader()
+
+        if self.offsetToPointer(execHeaderSize) != header.textAddr:
+            raise ValueError("Unexpected load address %08x of executable" % header.textAddr)
+
+        offset = execHeaderSize + header.textSize
+        start = self.offsetToPointer(offset)
+        limit = wa.map.mapBasePointer
+
+        heapBase = wa.data.execHeapBase(self.version)
+        if heapBase is not None:
+            limit = min(limit, heapBase)
+        elif not header.bssSize:
+            raise EnvironmentError("The free memory after the main executable is not known for this version of the game, so the executable cannot be expanded")
+
+        if header.bssSize:
+            if header.bssAddr >= start:
+                limit = min(limit, header.bssAddr)
+            elif header.bssAddr + header.bssSize > start:
+                limit = start
+
+        return offset, max(0, limit - start)
+
+    # Extend the loaded part of the executable so that it covers the file
+    # data up to the given offset, and update the header. The data must be
+    # a bytearray.
+    def expand(self, endOffset):
+        header = self.getHeader()
+
+        endOffset = (endOffset + execAlignment - 1) & ~(execAlignment - 1)
+        if endOffset <= execHeaderSize + header.textSize:
+            return
+
+        if len(self.data) < endOffset:
+            self.data.extend(bytes(endOffset - len(self.data)))
+
+        header.textSize = endOffset - execHeaderSize
+        header.pack(self.data)
+
+    # Return the tuple of pointers in a pointer table.
+    def getPointers(self, tableOffset, numPointers):
+        key = (tableOffset, numPointers)
+
+        pointers = self._pointers.get(key)
+        if pointers is None:
+            pointers = struct.unpack_from("<%dL" % numPointers, self.data, tableOffset)
+            self._pointers[key] = pointers
+
+        return pointers
+
+    # Return the strings of the string table with the given index in
+    # wa.data.execFileData() as a list of (prefix, string) tuples, where
+    # 'prefix' holds the data bytes before the text, and 'string' the text
+    # up to the terminating null byte.
+    def getStringTable(self, index):
+        table = self._stringTables.get(index)
+        if table is not None:
+            return table
+
+        tableOffset, numStrings, dataOffset, dataSize, specialBytes, specialHack, transDir, transFileName = wa.data.execFileData(self.version)[index]
+
+        table = []
+        specialCount = 2
+
+        for p in self.getPointers(tableOffset, numStrings):
+
+            # Hack for one table whose first two strings have two additional data bytes
+            if specialHack and specialCount > 0:
+                skipBytes = specialBytes + 2
+                specialCount -= 1
+            else:
+                skipBytes = specialBytes
+
+            # Extract string data until the first null byte
+            o = self.pointerToOffset(p)
+            table.append((self.data[o:o + skipBytes], self.data[o + skipBytes:self.data.index(b'\0', o + skipBytes)]))
+
+        self._stringTables[index] = table
+        return table
+
+    # Return the strings of the simple string table with the given index in
+    # wa.data.execFileData2() as a list of fixed-size byte strings.
+    def getSimpleTable(self, index):
+        table = self._simpleTables.get(index)
+        if table is not None:
+            return table
+
+        offset, numStrings, stringSize, encoding, transDir, transFileName = wa.data.execFileData2(self.version)[index]
+
+        table = [self.data[base:base + stringSize] for base in range(offset, offset + numStrings * stringSize, stringSize)]
+
+        self._simpleTables[index] = table
+        return table
+
+    # Return the name of a map as a string.
+    def getMapName(self, mapNumber):
+        name = self._mapNames.get(mapNumber)
+        if name is not None:
+            return name
+
+        nameTableOffset = wa.data.mapNameTableOffset(self.version)
+
+        p = struct.unpack_from("<L", self.data, nameTableOffset + mapNumber * 4)[0]
+        o = self.pointerToOffset(p)
+        name = wa.text.decode(self.data[o:self.data.index(b'\0', o)], self.version)
+
+        self._mapNames[mapNumber] = name
+        return name
+
+    # Return the embedded scripts as a list of scripts, each of which is a
+    # list of Instruction objects up to and including the final RETURN
+    # instruction.
+    def getScripts(self):
+        if self._scripts is not None:
+            return self._scripts
+
+        tableOffset, numScripts, dataOffset, dataSize = wa.data.execScriptData(self.version)
+
+        scripts = []
+
+        for p in self.getPointers(tableOffset, numScripts):
+            offset = self.pointerToOffset(p)
+
+            script = []
+            while True:
+                instr = wa.map.parseInstruction(self.data, offset, self.version, self.baseAddr)
+                script.append(instr)
+
+                if instr.op == Op.RETURN:
+                    break
+
+                offset += instr.length
+
+            scripts.append(script)
+
+        self._scripts = scripts
+        return scripts
+
+
+# Read the main executable of a game image, returning an ExecFile object.
+def readExec(image):
+    file = image.openFile("EXE", "WILDARMS.EXE")
+    data = file.read()
+    file.close()
+
+    return ExecFile(data, image.version)
+
+
+# Block of free space in the executable which is filled with string data.
+#
+# Attributes:
+#   offset = file offset of the block
+#   size   = size of the block in bytes
+#   data   = bytearray of the string data placed in the block so far
+class FreeBlock:
+    __slots__ = ("offset", "size", "data")
+
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+        self.data = bytearray()
+
+    def __repr__(self):
+        return "<FreeBlock %x: %d of %d bytes used>" % (self.offset, len(self.data), self.size)
+
+    # Return the number of unused bytes in the block.
+    def getFree(self):
+        return self.size - len(self.data)
+
+
+# Allocator which places null-terminated strings into blocks of free space.
+#
+# Identical strings are stored only once, and a string which is the tail of
+# another one is not stored at all but points into the longer string. The
+# remaining strings are distributed over the blocks by best-fit decreasing
+# bin packing. Overflow blocks are only used for strings which do not fit
+# into any of the regular blocks.
+#
+# Attributes:
+#   blocks         = list of regular FreeBlock objects
+#   overflowBlocks = list of FreeBlock objects for the overflow
+#   savedBytes     = number of bytes saved by sharing strings
+class StringAllocator:
+
+    # Create an allocator for the given list of (offset, size) tuples of
+    # regular and overflow blocks.
+    def __init__(self, blocks, overflowBlocks = []):
+        self.blocks = [FreeBlock(offset, size) for offset, size in blocks]
+        self.overflowBlocks = [FreeBlock(offset, size) for offset, size in overflowBlocks if size > 0]
+        self.savedBytes = 0
+
+    # Find the block with the least free space which can still hold the
+    # given number of bytes, or None if there is none.
+    def _bestFit(self, blocks, size):
+        best = None
+
+        for block in blocks:
+            free = block.getFree()
+            if free >= size and (best is None or free < best.getFree()):
+                best = block
+
+        return best
+
+    # Place a list of strings, returning a dictionary which maps each string
+    # (as a bytes object) to its file offset. Raises ValueError if there is
+    # not enough room.
+    def allocate(self, strings):
+        strings = [bytes(s) for s in strings]
+        unique = set(strings)
+
+        # Find the strings which are the tail of another string. Sorting the
+        # reversed strings puts each string right before the strings it is
+        # the tail of.
+        reverseSorted = sorted(unique, key = lambda s: s[::-1])
+
+        hostOf = {}
+        for s, t in zip(reverseSorted, reverseSorted[1:]):
+            if t.endswith(s):
+                hostOf[s] = t
+
+        # Place the other strings, longest first
+        offsetOfString = {}
+        placed = 0
+        missing = 0
+
+        for s in sorted(unique - hostOf.keys(), key = lambda s: (-len(s), s)):
+            block = self._bestFit(self.blocks, len(s)) or self._bestFit(self.overflowBlocks, len(s))
+            if block is None:
+                missing += len(s)
+                continue
+
+            offsetOfString[s] = block.offset + len(block.data)
+            block.data.extend(s)
+            placed += len(s)
+
+        if missing:
+            raise ValueError("Not enough room for strings (%d more bytes needed)" % missing)
+
+        # Point the tails into their hosts, working backwards so the host
+        # of each tail already has its offset
+        for s in reversed(reverseSorted):
+            t = hostOf.get(s)
+            if t is not None:
+                offsetOfString[s] = offsetOfString[t] + len(t) - len(s)
+
+        self.savedBytes += sum(len(s) for s in strings) - placed
+
+        return offsetOfString
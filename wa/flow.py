@@ -0,0 +1,231 @@
+#
+# wa.flow - Control flow analysis of map scripts
+#
+# Copyright (C) Christian Bauer <www.cebix.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+
+import bisect
+import struct
+
+from wa.map import Op, opcodes, addrToOffset
+
+
+#
+# The script sections of a map are decoded by a linear sweep, which uses a
+# heuristic to tell string literals from instructions. The control flow
+# analysis follows the execution paths from the entry tables through all
+# branch targets, which tells precisely which instructions are executable
+# code and which are embedded data, and finds places where the sweep went
+# wrong.
+#
+
+# Opcodes of instructions after which execution does not continue with the
+# next instruction
+_terminatorOps = frozenset([Op.RETURN, Op.HALT, Op.JUMP, Op.BREAK, Op.GAMEOVER])
+
+
+# Object representing a basic block: a sequence of instructions which is
+# only entered at the first one and only left after the last one.
+#
+# Attributes:
+#   start      = address of the first instruction
+#   instrs     = list of Instruction objects
+#   successors = list of the start addresses of the successor blocks
+class BasicBlock:
+    __slots__ = ("start", "instrs", "successors")
+
+    def __init__(self, start):
+        self.start = start
+        self.instrs = []
+        self.successors = []
+
+    def __repr__(self):
+        return "<BasicBlock %04x: %d instructions>" % (self.start, len(self.instrs))
+
+
+# Control flow graph of script code.
+#
+# Attributes:
+#   blocks    = dictionary of start address to BasicBlock
+#   reachable = set of addresses of reachable instructions
+#   dataRefs  = set of addresses referenced by expressions in reachable code
+#   hidden    = list of unreachable MESSAGE instructions (hidden text)
+#   data      = list of other unreachable instructions (embedded data and
+#               dead code)
+#   problems  = list of (addr, description) tuples describing
+#               inconsistencies between the control flow and the decoded
+#               instructions, which indicate errors of the linear sweep
+class FlowGraph:
+
+    # Build the graph for a list of script sections, each given as a list of
+    # Instruction objects, starting from a dictionary which maps each entry
+    # address to a list of labels. Entry addresses outside of the script
+    # sections are ignored.
+    def __init__(self, scripts, entries):
+        self.blocks = {}
+        self.reachable = set()
+        self.dataRefs = set()
+        self.hidden = []
+        self.data = []
+        self.problems = []
+
+        # Collect the instructions, leaving out the entry tables at the
+        # start of the sections, and note where each section ends
+        self.instrs = []
+        self.sectionEnds = set()
+        self.ranges = []
+
+        for script in scripts:
+            instrs = [instr for instr in script if instr.op != Op.ENTRY]
+            if not instrs:
+                continue
+
+            start = addrToOffset(instrs[0].addr)
+            end = addrToOffset(instrs[-1].addr) + instrs[-1].length
+            self.ranges.append((start, end))
+
+            self.instrs += instrs
+            self.sectionEnds.add(len(self.instrs))
+
+        self.offsets = [addrToOffset(instr.addr) for instr in self.instrs]
+        self.index = {instr.addr: i for i, instr in enumerate(self.instrs)}
+
+        # Find the reachable instructions
+        visited, leaders = self._walk(entries)
+
+        # Divide them into basic blocks
+        self._buildBlocks(visited, leaders)
+
+        # Classify the unreachable instructions
+        for i, instr in enumerate(self.instrs):
+            if i in visited:
+                continue
+
+            if instr.op == Op.MESSAGE:
+                self.hidden.append(instr)
+            else:
+                self.data.append(instr)
+
+                if instr.addr in self.dataRefs and instr.op not in [Op.STRING, Op.PTR]:
+                    self.problems.append((instr.addr, "data referenced by expression not decoded as string"))
+
+        self.problems.sort(key = lambda problem: addrToOffset(problem[0]))
+
+    # Find the index of the instruction starting at an address. Returns None
+    # for addresses outside of the script sections, or inside an instruction,
+    # which is reported as a problem.
+    def _lookup(self, addr, source):
+        i = self.index.get(addr)
+        if i is not None:
+            return i
+
+        offset = addrToOffset(addr)
+        if any(start <= offset < end for start, end in self.ranges):
+            j = bisect.bisect_right(self.offsets, offset) - 1
+            self.problems.append((addr, "%s points into instruction at %04x" % (source, self.instrs[j].addr)))
+
+        return None
+
+    # Follow the execution paths from the entry points with a worklist,
+    # returning the set of indexes of reachable instructions, and the set
+    # of indexes of instructions which start a basic block.
+    def _walk(self, entries):
+        visited = set()
+        leaders = set()
+        work = []
+
+        for addr in sorted(entries):
+            i = self._lookup(addr, "Entry %d.%d" % entries[addr][0])
+            if i is not None:
+                leaders.add(i)
+                work.append(i)
+
+        while work:
+            i = work.pop()
+
+            while i not in visited:
+                visited.add(i)
+                instr = self.instrs[i]
+
+                if instr.op == Op.STRING:
+                    self.problems.append((instr.addr, "string literal is reachable from code"))
+                    break
+                elif instr.op == Op.PTR:
+                    self.problems.append((instr.addr, "bogus pointer is reachable from code"))
+                    break
+
+                # Collect branch targets and the script addresses used by
+                # expressions
+                target = instr.getTarget()
+
+                for offset in instr.reloc:
+                    addr = struct.unpack_from("<H", instr.bytes, offset)[0]
+                    if addr != target:
+                        self.dataRefs.add(addr)
+
+                if target is not None:
+                    j = self._lookup(target, "%s at %04x" % (opcodes[instr.op][1], instr.addr))
+                    if j is not None:
+                        leaders.add(j)
+                        work.append(j)
+
+                if instr.op in _terminatorOps:
+                    break
+
+                # Continue with the next instruction
+                i += 1
+
+                if i in self.sectionEnds:
+                    self.problems.append((instr.addr, "execution continues past the end of the script section"))
+                    break
+
+                if target is not None:
+                    leaders.add(i)
+
+        self.reachable = {self.instrs[i].addr for i in visited}
+        return visited, leaders
+
+    # Divide the reachable instructions into basic blocks.
+    def _buildBlocks(self, visited, leaders):
+        block = None
+        prev = None
+
+        for i in sorted(visited):
+            instr = self.instrs[i]
+
+            if block is None or i in leaders or i != prev + 1:
+                if block is not None and i == prev + 1 and i not in self.sectionEnds:
+                    block.successors.append(instr.addr)  # fall through into the next block
+
+                block = BasicBlock(instr.addr)
+                self.blocks[instr.addr] = block
+
+            block.instrs.append(instr)
+            prev = i
+
+            # End the block after branches and terminators
+            target = instr.getTarget()
+
+            if target is not None or instr.op in _terminatorOps or instr.op in [Op.STRING, Op.PTR]:
+                if target in self.index:
+                    block.successors.append(target)
+
+                if instr.op not in _terminatorOps and i + 1 in visited and i + 1 not in self.sectionEnds:
+                    block.successors.append(self.instrs[i + 1].addr)
+
+                block = None
+
+
+# Build the control flow graph of the scripts of a MapData object. The
+# scripts are extracted if they are not given.
+def analyzeMap(mapData, script1 = None, script2 = None):
+    if script1 is None:
+        script1 = mapData.getScript1()
+    if script2 is None:
+        script2 = mapData.getScript2()
+
+    return FlowGraph([script1, script2], mapData.getEntryIndex())
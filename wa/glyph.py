@@ -0,0 +1,115 @@
+#
+# wa.glyph - Kanji glyph matching
+#
+# Copyright (C) Christian Bauer <www.cebix.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+
+
+# Glyph bitmaps consist of 11 lines of 16 bits (of which only 12 are used),
+# stored MSB first. For matching, the entire bitmap is packed into one
+# 176-bit integer, so the Hamming distance between two glyphs is the
+# population count of their XOR.
+glyphLines = 11
+glyphSize = glyphLines * 2
+
+# Mask for the upper half of a packed glyph (lines 0..5)
+_topMask = ((1 << 96) - 1) << 80
+
+
+# Pack glyph bitmap data into an integer.
+def packGlyph(glyph):
+    return int.from_bytes(glyph, "big")
+
+
+# Return the coarse features of a packed glyph, which are used for
+# bucketing: the number of set pixels in the upper and lower half of the
+# glyph. The sum of the feature differences of two glyphs is a lower bound
+# for their Hamming distance.
+def _features(bits):
+    top = (bits & _topMask).bit_count()
+    return (top, bits.bit_count() - top)
+
+
+# Object representing a match found by GlyphIndex.search().
+#
+# Attributes:
+#   char       = unicode character of the matching glyph
+#   distance   = Hamming distance (number of differing pixels)
+#   confidence = similarity in the range 0..1 (1 - distance / number of
+#                pixels set in either glyph)
+class GlyphMatch:
+    __slots__ = ("char", "distance", "confidence")
+
+    def __init__(self, char, distance, confidence):
+        self.char = char
+        self.distance = distance
+        self.confidence = confidence
+
+    def __repr__(self):
+        return "<GlyphMatch '%s' distance %d confidence %.2f>" % (self.char, self.distance, self.confidence)
+
+
+# Index of known glyphs for nearest-neighbour search.
+class GlyphIndex:
+
+    # Create an empty index.
+    def __init__(self):
+        self.chars = {}    # mapping of packed glyph to character
+        self.buckets = {}  # mapping of features to list of (packed glyph, character)
+
+    # Return the number of glyphs in the index.
+    def __len__(self):
+        return len(self.chars)
+
+    # Add a glyph with its unicode character to the index.
+    def add(self, glyph, char):
+        bits = packGlyph(glyph)
+        if bits in self.chars:
+            return
+
+        self.chars[bits] = char
+        self.buckets.setdefault(_features(bits), []).append((bits, char))
+
+    # Add a font consisting of consecutive glyph bitmaps to the index, given
+    # the string of characters it contains.
+    def addFont(self, data, chars, offset = 0):
+        for c in chars:
+            self.add(data[offset:offset + glyphSize], c)
+            offset += glyphSize
+
+    # Find the known glyphs closest to the given glyph bitmap, returning a
+    # list of up to 'count' GlyphMatch objects, closest first. Glyphs with a
+    # distance larger than 'maxDistance' are not considered.
+    def search(self, glyph, count = 3, maxDistance = 64):
+        bits = packGlyph(glyph)
+        top, bottom = _features(bits)
+
+        # Visit the buckets in order of increasing lower bound of the
+        # distance, and stop as soon as no bucket can improve on the
+        # matches found so far
+        buckets = sorted((abs(t - top) + abs(b - bottom), (t, b)) for t, b in self.buckets)
+
+        found = []  # sorted list of (distance, -union, char)
+        limit = maxDistance
+
+        for bound, key in buckets:
+            if bound > limit:
+                break
+
+            for other, char in self.buckets[key]:
+                d = (bits ^ other).bit_count()
+                if d > limit:
+                    continue
+
+                found.append((d, -(bits | other).bit_count(), char))
+                found.sort()
+                del found[count:]
+
+                if len(found) == count:
+                    limit = found[-1][0]
+
+        return [GlyphMatch(char, d, 1 - d / max(1, -union)) for d, union, char in found]
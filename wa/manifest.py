@@ -0,0 +1,125 @@
+#
+# wa.manifest - Record of the inputs and outputs of tool runs
+#
+# Copyright (C) Christian Bauer <www.cebix.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+
+import hashlib
+import json
+import os
+
+
+#
+# A manifest records for each stage of a tool run the hashes of the input
+# files and settings the stage used, and of the output files it produced.
+# On the next run, a stage whose inputs are the same and whose outputs have
+# not been changed since can be skipped.
+#
+# The manifest is stored as a JSON file:
+#
+#   {
+#     "format": 1,
+#     "stages": {
+#       "<name>": {"inputs": {"<key>": "<hash>", ...},
+#                  "outputs": {"<key>": "<hash>", ...}},
+#       ...
+#     }
+#   }
+#
+# Missing files have the hash null.
+#
+
+manifestFormatVersion = 1
+
+
+# Return the SHA-1 hash of a file as a hex string, or None if the file does
+# not exist.
+def hashFile(filePath):
+    h = hashlib.sha1()
+
+    try:
+        with open(filePath, "rb") as f:
+            while True:
+                data = f.read(0x100000)
+                if not data:
+                    break
+                h.update(data)
+    except FileNotFoundError:
+        return None
+
+    return h.hexdigest()
+
+
+# Return the SHA-1 hash of a string as a hex string.
+def hashString(s):
+    return hashlib.sha1(s.encode("utf-8")).hexdigest()
+
+
+# Record of the stages of a tool run, stored in a file.
+class Manifest:
+
+    # Load the manifest from the given file. A missing or invalid file
+    # yields an empty manifest.
+    def __init__(self, filePath):
+        self.filePath = filePath
+        self.stages = {}
+
+        try:
+            with open(filePath, "r", encoding = "utf-8") as f:
+                content = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if isinstance(content, dict) and content.get("format") == manifestFormatVersion:
+            self.stages = content.get("stages", {})
+
+    # Check whether a stage was recorded with the given dictionaries of
+    # input and output hashes.
+    def isCurrent(self, name, inputs, outputs):
+        entry = self.stages.get(name)
+        return entry is not None and entry["inputs"] == inputs and entry["outputs"] == outputs
+
+    # Return the recorded input hashes of a stage, or None if the stage is
+    # not recorded.
+    def getInputs(self, name):
+        entry = self.stages.get(name)
+        return entry["inputs"] if entry is not None else None
+
+    # Record a stage with the given dictionaries of input and output hashes.
+    def set(self, name, inputs, outputs):
+        self.stages[name] = {"inputs": inputs, "outputs": outputs}
+
+    # Remove the record of a stage.
+    def remove(self, name):
+        self.stages.pop(name, None)
+
+    # Remove the records of all stages.
+    def clear(self):
+        self.stages = {}
+
+    # Return the names of all recorded stages.
+    def getNames(self):
+        return list(self.stages.keys())
+
+    # Write the manifest to its file. The file is replaced atomically, so an
+    # interrupted run never leaves a partial manifest.
+    def save(self):
+        content = {"format": manifestFormatVersion, "stages": self.stages}
+
+        tmpPath = self.filePath + ".%d.tmp" % os.getpid()
+
+        try:
+            with open(tmpPath, "w", encoding = "utf-8") as f:
+                json.dump(content, f, indent = 1, sort_keys = True)
+            os.replace(tmpPath, self.filePath)
+        except OSError as e:
+            try:
+                os.remove(tmpPath)
+            except OSError:
+                pass
+
+            raise EnvironmentError("Cannot write manifest file '%s': %s" % (self.filePath, e.strerror))
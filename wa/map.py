@@ -8,7 +8,13 @@
 # copyright notice and this permission notice appear in all copies.
 #
 
+import array
+import copy
+import multiprocessing
+import queue
 import struct
+import sys
+import threading
 
 import wa
 
@@ -37,6 +43,19 @@ mapBasePointer = 0x8014f000
 # Start address of map graphics data in memory
 mapGfxPointer = 0x80164000
 
+# Size of a map data block in CDSTG.BIN
+mapBlockSize = 0x91000
+
+# Offset of the graphics data within a map data block
+mapGfxOffset = 0x15000
+
+# Number of map data blocks in CDSTG.BIN
+numMaps = 128
+
+# Maps which are dummied out
+dummyMaps = [25]
+
+
 # Convert pointer to offset.
 def pointerToOffset(pointer):
     return pointer - mapBasePointer
@@ -105,81 +124,295 @@ exOpcodes = [
 ]
 
 
-# Parse and disassemble a recursive prefix expression,
-# returning the tuple (length, string).
-def parseExpression(data, offset, reloc = [], assignment = False):
+# Object representing a node of a parsed prefix expression.
+#
+# Attributes:
+#   op       = expression opcode (int)
+#   offset   = offset of the opcode in the data
+#   length   = length of the expression including all operands in bytes
+#   value    = value of immediate values and script addresses, None otherwise
+#   operands = tuple of operand nodes:
+#                unary operator: (lhs,)
+#                binary operator: (lhs, rhs)
+#                assignable variable: () or (rhs,) for an assignment
+#                indexed variable: (index,) or (index, rhs) for an assignment
+class Expression:
+    __slots__ = ("op", "offset", "length", "value", "operands")
+
+    def __init__(self, op, offset):
+        self.op = op
+        self.offset = offset
+        self.length = 1
+        self.value = None
+        self.operands = ()
+
+    def __repr__(self):
+        return "<Expression %s>" % self.format()
+
+    # Check whether the expression is an assignment.
+    def isAssignment(self):
+        if self.op <= 0x10 or self.op in [0x12, 0x15, 0x20]:
+            return False
+        elif self.op in [0x11, 0x21]:
+            return len(self.operands) == 1
+        else:
+            return len(self.operands) == 2
 
-    # Fetch opcode
-    op = data[offset]
-    length = 1
+    # Disassemble the expression, returning a string.
+    def format(self):
+        op = self.op
+        opStr = exOpcodes[op]
 
-    opStr = exOpcodes[op]
+        if op == 0x09:
 
-    if op == 0x09:
+            # Unary operator
+            return "(" + self.operands[0].format() + " " + opStr + ")"
 
-        # Unary operator
-        lhsLen, lhsStr = parseExpression(data, offset + 1, reloc)
+        elif op < 0x10:
 
-        length += lhsLen
-        str = "(" + lhsStr + " " + opStr + ")"
+            # Binary operator
+            lhs, rhs = self.operands
+            return "(" + lhs.format() + " " + opStr + " " + rhs.format() + ")"
 
-    elif op < 0x10:
+        elif op == 0x10:
 
-        # Binary operator
-        lhsLen, lhsStr = parseExpression(data, offset + 1, reloc)
-        rhsLen, rhsStr = parseExpression(data, offset + 1 + lhsLen, reloc)
+            # Immediate value
+            return "%d" % self.value
 
-        length += lhsLen + rhsLen
-        str = "(" + lhsStr + " " + opStr + " " + rhsStr + ")"
+        elif op == 0x15:
 
-    elif op == 0x10:
+            # Script address
+            return "(addr %04x)" % self.value
 
-        # Immediate value
-        v = struct.unpack_from("<h", data, offset + 1)[0]
+        elif op in [0x11, 0x12, 0x20, 0x21]:
 
-        length += 2
-        str = "%d" % v
+            # Simple or assignable variable
+            s = opStr
 
-    elif op == 0x15:
+        else:
 
-        # Script address
-        reloc.append(offset + 1)
-        v = struct.unpack_from("<H", data, offset + 1)[0]
+            # Assignable indexed variable
+            s = opStr + "[" + self.operands[0].format() + "]"
 
-        length += 2
-        str = "(addr %04x)" % v
+        if self.isAssignment():
+            s += " = " + self.operands[-1].format()
 
-    elif op in [0x12, 0x20]:
+        return s
 
-        # Simple variable
-        str = opStr
+    # Return a list of the offsets of the script addresses within the
+    # expression.
+    def getReloc(self):
+        reloc = []
 
-    elif op in [0x11, 0x21]:
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node.op == 0x15:
+                reloc.append(node.offset + 1)
+            else:
+                stack.extend(reversed(node.operands))
 
-        # Assignable variable
-        str = opStr
+        return reloc
 
-        if assignment:
-            lhsLen, lhsStr = parseExpression(data, offset + 1, reloc)
+    # Evaluate the expression with the semantics of C integer arithmetic.
+    # The values of variables are obtained by calling lookup(name, index),
+    # where 'name' is the name of the variable ("var", "flag", "gold" etc.)
+    # and 'index' is the evaluated index, or None for non-indexed variables.
+    # The value of an assignment is the assigned value.
+    def evaluate(self, lookup):
+        op = self.op
 
-            length += lhsLen
-            str += " = " + lhsStr
+        if op < 0x10:
+            if op == 0x09:
+                return int(self.operands[0].evaluate(lookup) == 0)
 
-    else:
+            lhs, rhs = [x.evaluate(lookup) for x in self.operands]
+            return _binaryOps[op](lhs, rhs)
+
+        elif op in [0x10, 0x15]:
+            return self.value
+
+        elif self.isAssignment():
+            return self.operands[-1].evaluate(lookup)
+
+        elif op in [0x11, 0x12, 0x20, 0x21]:
+            return lookup(exOpcodes[op], None)
+
+        else:
+            return lookup(exOpcodes[op], self.operands[0].evaluate(lookup))
+
+
+# Integer division and remainder truncating toward zero, as in C
+def _div(a, b):
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def _mod(a, b):
+    return a - _div(a, b) * b
+
+_binaryOps = [
+    lambda a, b: int(a == b),
+    lambda a, b: int(a != b),
+    lambda a, b: int(a > b),
+    lambda a, b: int(a >= b),
+    lambda a, b: int(a < b),
+    lambda a, b: int(a <= b),
+    lambda a, b: a & b,
+    lambda a, b: a | b,
+    lambda a, b: a ^ b,
+    None,
+    lambda a, b: a + b,
+    lambda a, b: a - b,
+    lambda a, b: a * b,
+    _div,
+    _mod,
+]
 
-        # Assignable indexed variable
-        rhsLen, rhsStr = parseExpression(data, offset + 1, reloc)
 
-        length += rhsLen
-        str = opStr + "[" + rhsStr + "]"
+# Parse a prefix expression at the given offset in the data and return the
+# root Expression node. The outermost expression of an assignment
+# instruction must be parsed with 'assignment' set. The parser works with an
+# explicit stack of nodes which are still missing operands, so deeply nested
+# expressions don't cause deep recursion.
+def parseExpression(data, offset, assignment = False):
+    pending = []  # list of (node, number of operands, list of operands)
+
+    while True:
+        op = data[offset]
+
+        if op >= len(exOpcodes) or exOpcodes[op] is None:
+            raise ValueError("Invalid expression opcode %02x at offset %x" % (op, offset))
+
+        node = Expression(op, offset)
+        offset += 1
+
+        if op == 0x09:
+
+            # Unary operator
+            numOperands = 1
+
+        elif op < 0x10:
+
+            # Binary operator
+            numOperands = 2
+
+        elif op == 0x10:
+
+            # Immediate value
+            node.value = struct.unpack_from("<h", data, offset)[0]
+            offset += 2
+            numOperands = 0
+
+        elif op == 0x15:
+
+            # Script address
+            node.value = struct.unpack_from("<H", data, offset)[0]
+            offset += 2
+            numOperands = 0
+
+        elif op in [0x12, 0x20]:
+
+            # Simple variable
+            numOperands = 0
+
+        elif op in [0x11, 0x21]:
+
+            # Assignable variable
+            numOperands = 1 if assignment else 0
+
+        else:
+
+            # Assignable indexed variable
+            numOperands = 2 if assignment else 1
 
-        if assignment:
-            lhsLen, lhsStr = parseExpression(data, offset + 1 + rhsLen, reloc)
+        # Only the outermost expression can be an assignment
+        assignment = False
 
-            length += lhsLen
-            str += " = " + lhsStr
+        if numOperands:
+            pending.append((node, numOperands, []))
+            continue
 
-    return length, str
+        # The node is complete; add it to its parent, completing all
+        # parents which thereby receive their last operand
+        node.length = offset - node.offset
+
+        while pending:
+            parent, numOperands, operands = pending[-1]
+            operands.append(node)
+
+            if len(operands) < numOperands:
+                break
+
+            pending.pop()
+            parent.operands = tuple(operands)
+            parent.length = offset - parent.offset
+            node = parent
+
+        if not pending:
+            return node
+
+
+# Determine the structure of a prefix expression without parsing it,
+# returning the tuple (length, reloc) where 'reloc' is a list of the offsets
+# of script addresses within the expression. This is a faster equivalent of
+# parseExpression() followed by getReloc() for decoding instructions.
+def scanExpression(data, offset, assignment = False):
+    start = offset
+    reloc = []
+
+    # Number of operands remaining to be scanned
+    pending = 1
+
+    while pending:
+        op = data[offset]
+
+        if op >= len(exOpcodes) or exOpcodes[op] is None:
+            raise ValueError("Invalid expression opcode %02x at offset %x" % (op, offset))
+
+        offset += 1
+        pending -= 1
+
+        if op == 0x09:
+
+            # Unary operator
+            pending += 1
+
+        elif op < 0x10:
+
+            # Binary operator
+            pending += 2
+
+        elif op == 0x10:
+
+            # Immediate value
+            offset += 2
+
+        elif op == 0x15:
+
+            # Script address
+            reloc.append(offset)
+            offset += 2
+
+        elif op in [0x12, 0x20]:
+
+            # Simple variable
+            pass
+
+        elif op in [0x11, 0x21]:
+
+            # Assignable variable
+            if assignment:
+                pending += 1
+
+        else:
+
+            # Assignable indexed variable
+            pending += 2 if assignment else 1
+
+        # Only the outermost expression can be an assignment
+        assignment = False
+
+    return offset - start, reloc
 
 
 #
@@ -189,6 +422,7 @@ def parseExpression(data, offset, reloc = [], assignment = False):
 Op = _enum(
     RETURN   =  0x00,  # return from subroutine
     CALL     =  0x01,  # call subroutine
+    HALT     =  0x02,  # stop script execution
     WINDOW   =  0x03,  # open message window
     CLOSE    =  0x04,  # close message window
     MESSAGE  =  0x06,  # message text
@@ -265,25 +499,48 @@ opcodes = [
 ]
 
 
-# Object representing one script instruction.
+# Object representing one script instruction. Scripts consist of many
+# small instructions, so the objects use slots instead of a dictionary, and
+# share the operand data and relocation lists where possible.
+#
+# The disassembly is only created when it is first accessed, as most users
+# of scripts only need the structure of the instructions and their text.
 #
 # Attributes:
 #   op     = opcode (int)
-#   len    = instruction length in bytes
+#   length = instruction length in bytes
 #   addr   = instruction start address
-#   bytes  = instruction data bytes
+#   bytes  = instruction data bytes (immutable bytes object)
 #   disass = disassembled instruction (string)
-#   reloc  = list of offsets (relative to start of instruction) to relocatable addresses within the instruction
+#   reloc  = tuple of offsets (relative to start of instruction) to relocatable addresses within the instruction
 class Instruction:
+    __slots__ = ("op", "length", "addr", "bytes", "reloc", "_disass", "_version", "_kanjiTable")
 
-    # Create an instruction object.
-    def __init__(self, op, length, addr, bytes, disass, reloc = []):
+    # Create an instruction object. If no disassembly is given it is
+    # created on demand from the data bytes, using the game version and
+    # Kanji table for decoding text.
+    def __init__(self, op, length, addr, bytes, disass = None, reloc = (), version = None, kanjiTable = None):
         self.op = op
         self.length = length
         self.addr = addr
         self.bytes = bytes
-        self.disass = disass
         self.reloc = reloc
+        self._disass = disass
+        self._version = version
+        self._kanjiTable = kanjiTable
+
+    def __repr__(self):
+        return "<Instruction %04x: %s>" % (self.addr, self.disass)
+
+    @property
+    def disass(self):
+        if self._disass is None:
+            self._disass = disassemble(self.op, self.bytes, self._version, self._kanjiTable)
+        return self._disass
+
+    @disass.setter
+    def disass(self, disass):
+        self._disass = disass
 
     # Get the text of MESSAGE and STRING instructions.
     # The text is encoded in the game character set and null-terminated.
@@ -299,270 +556,347 @@ class Instruction:
     # The text must be encoded in the game character set and null-terminated.
     def setText(self, text):
         if self.op == Op.MESSAGE:
-            self.bytes = bytearray([Op.MESSAGE]) + bytearray(text)
+            self.bytes = bytes([Op.MESSAGE]) + text
             self.length = len(self.bytes)
             self.disass = "message"
         elif self.op == Op.STRING:
-            self.bytes = bytearray(text)
+            self.bytes = bytes(text)
             self.length = len(self.bytes)
             self.disass = "string"
         else:
             raise ValueError("setText() called for instruction " + self.disass)
 
+    # Parse the expression of ASSIGN, IF and WHILE instructions and return
+    # the root Expression node.
+    def getExpression(self):
+        if self.op == Op.ASSIGN:
+            return parseExpression(self.bytes, 1, True)
+        elif self.op in [Op.IF, Op.WHILE]:
+            return parseExpression(self.bytes, 1)
+        else:
+            raise ValueError("getExpression() called for instruction " + self.disass)
+
+    # Return the branch target address of CALL, JUMP, BREAK, IF and WHILE
+    # instructions, or None for other instructions and calls of the special
+    # target 0xfffe.
+    def getTarget(self):
+        if self.op in _branchOps and self.reloc:
+            return struct.unpack_from("<H", self.bytes, self.reloc[-1])[0]
+        else:
+            return None
+
     # Relocate addresses within the instruction operands according to a
     # mapping of old to new addresses.
     def relocate(self, addrMap):
+        if not self.reloc:
+            return
+
+        data = bytearray(self.bytes)
+
         for offset in self.reloc:
-            oldAddr = struct.unpack_from("<H", self.bytes, offset)[0]
+            oldAddr = struct.unpack_from("<H", data, offset)[0]
             newAddr = addrMap[oldAddr]
 
             # Target address 0xfffe for CALL is special
             if self.op == Op.CALL and newAddr == 0xfffe:
                 raise ValueError("Target address of CALL instruction at %04x relocated to %04x" % (self.addr, newAddr))
 
-            struct.pack_into("<H", self.bytes, offset, newAddr)
-
+            struct.pack_into("<H", data, offset, newAddr)
 
-# Decode one instruction at the given offset in the data and return an
-# Instruction object.
-def parseInstruction(data, offset, version, basePointer = mapBasePointer, kanjiBitmap = None):
+        self.bytes = bytes(data)
 
-    # Fetch opcode
-    op = data[offset]
 
-    # The linker used for building the game has the habit
-    # of inserting pointers to the current location in
-    # some places. We need to skip these.
-    p = struct.unpack_from("<L", data, offset)[0]
+# Opcodes of instructions with a branch target
+_branchOps = frozenset([Op.CALL, Op.JUMP, Op.BREAK, Op.IF, Op.WHILE])
 
-    if (offset % 4 == 0) and p == offset + 0x8014f000:
-        return Instruction(Op.PTR, 4, offsetToAddr(offset, basePointer), data[offset:offset + 4], "<PTR>")
+# Relocation offsets shared by all instructions of the same kind
+_noReloc = ()
+_operandReloc = (1,)
+_entryReloc = (0,)
 
-    # Heuristic for detecting string literals embedded within the code.
-    # A more solid way would be to do a control flow analysis of the
-    # code, or to look for the "addr" expression opcodes which reference
-    # the strings.
-    if (op == 0x05) or (op > 0x28) or (p == 0x20202020) or \
-       ((op == 0x11) and (data[offset + 2] not in [0x00, 0xff])) or \
-       ((op == 0x20) and (data[offset + 1] >= 0x20)):
 
-        end = data.index(b'\0', offset)
-        length = end - offset + 1
-        t = wa.text.decode(data[offset:end], version, kanjiBitmap)
+#
+# Structural decoding of instruction operands
+#
+# Each function takes the data and the offset of an instruction and returns
+# the tuple (length, reloc). Opcodes without a decoder have the fixed length
+# given in the 'opcodes' table and no relocations.
+#
 
-        return Instruction(Op.STRING, length, offsetToAddr(offset, basePointer), data[offset:end + 1], "string " + t)
+def _decodeMessage(data, offset):
 
-    # Regular instruction
-    length, disass = opcodes[op]
-    reloc = []
+    # Operand is text until null byte
+    return data.index(b'\0', offset) - offset + 1, _noReloc
 
-    # Get operand
-    if op == Op.MESSAGE:
+def _decodeTarget(data, offset):
 
-        # Operand is text until null byte
-        end = data.index(b'\0', offset)
-        disass += " " + wa.text.decode(data[offset + 1:end], version, kanjiBitmap)
-        length = end - offset + 1
-
-    elif op in [Op.CALL, Op.JUMP, Op.BREAK]:
+    # Operand is a script address; target address 0xfffe for CALL is special
+    if data[offset] == Op.CALL and struct.unpack_from("<H", data, offset + 1)[0] == 0xfffe:
+        return 3, _noReloc
+    else:
+        return 3, _operandReloc
 
-        # Operand is a script address
-        addr = struct.unpack_from("<H", data, offset + 1)[0]
-        disass += " %04x" % addr
+def _decodeWindow(data, offset):
 
-        # Target address 0xfffe for CALL is special
-        if op != Op.CALL or addr != 0xfffe:
-            reloc.append(1)
+    # Window type 3 has additional operands
+    if data[offset + 1] == 3:
+        return 12, _noReloc
+    else:
+        return 2, _noReloc
 
-    elif op == Op.WINDOW:
+def _decodeAssign(data, offset):
 
-        # Window type 3 has additional operands
-        sel = data[offset + 1]
-        disass += " %d" % sel
+    # Operand is an assignment expression
+    exLen, exReloc = scanExpression(data, offset + 1, True)
+    return 1 + exLen, tuple(x - offset for x in exReloc)
 
-        if sel == 3:
-            param = struct.unpack_from("<5H", data, offset + 2)
-            disass += " type %d, x/y = (%d, %d), w/h = (%d, %d)" % param
-            length += 10
+def _decodeCondition(data, offset):
 
-    elif op == Op.ASSIGN:
+    # Operands are an expression followed by a script address
+    exLen, exReloc = scanExpression(data, offset + 1)
+    return 3 + exLen, tuple(x - offset for x in exReloc) + (1 + exLen,)
 
-        # Operand is an assignment expression
-        exReloc = []
-        exLen, exStr = parseExpression(data, offset + 1, exReloc, True)
+def _decode0d(data, offset):
+    if data[offset + 1] in [0xfc, 0xfd, 0xfe]:
+        return 8, _noReloc
+    else:
+        return 7, _noReloc
 
-        reloc += [(x - offset) for x in exReloc]
+def _decodeWait(data, offset):
+    if struct.unpack_from("<H", data, offset + 1)[0] in [0xfff2, 0xfff3, 0xfff9, 0xfffc]:
+        return 5, _noReloc
+    else:
+        return 3, _noReloc
 
-        disass += " " + exStr
-        length += exLen
+def _decodeMove(data, offset):
 
-    elif op in [Op.IF, Op.WHILE]:
+    # Operand is terminated by 0xfe/0xff
+    end = offset + 3
+    while data[end] not in [0xfe, 0xff]:
+        end += 1
 
-        # Operands are an expression followed by a script address
-        exReloc = []
-        exLen, exStr = parseExpression(data, offset + 1, exReloc)
+    return end - offset + 1, _noReloc
 
-        reloc += [(x - offset) for x in exReloc]
-        reloc.append(1 + exLen)
-        addr = struct.unpack_from("<H", data, offset + 1 + exLen)[0]
+_vfxLength = {0xf1: 7, 0xf4: 8, 0xfd: 8, 0xf5: 5, 0xf6: 5, 0xfb: 4, 0xff: 10}
 
-        disass += " " + exStr + (": (else jump %04x)" % addr)
-        length += exLen + 2
+def _decodeVfx(data, offset):
+    return _vfxLength.get(data[offset + 1], 2), _noReloc
 
-    elif op == 0x0d:
+def _decodeMenu(data, offset):
 
-        # Operand is variable
-        sel = data[offset + 1]
+    # Operands depend on menu type
+    sel = data[offset + 1]
 
-        if sel in [0xfc, 0xfd, 0xfe]:
-            length += 1
+    if sel == 0x02:
+        return 4, _noReloc
+    elif sel == 0x03:
+        return data.index(b'\xff', offset) - offset + 1, _noReloc
+    elif sel in [0x08, 0x09]:
+        return 3, _noReloc
+    else:
+        return 2, _noReloc
 
-        disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
+def _decode19(data, offset):
+    if data[offset + 3] == 0xff:
+        return 7, _noReloc
+    else:
+        return 4, _noReloc
 
-    elif op == Op.WAIT:
+def _decode1a(data, offset):
+    if data[offset + 1] in [0xfe, 0xff]:
+        return data.index(b'\xff\xff', offset + 2) - offset + 2, _noReloc
+    else:
+        return data.index(b'\xff', offset + 2) - offset + 1, _noReloc
 
-        # Operand is variable
-        sel = struct.unpack_from("<H", data, offset + 1)[0]
+def _decode1f(data, offset):
+    if data[offset + 1] != 0:
+        return 14, _noReloc
+    else:
+        return 4, _noReloc
 
-        if sel in [0xfff2, 0xfff3, 0xfff9, 0xfffc]:
-            length += 2
+def _decodeTimer(data, offset):
 
-        disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
+    # Last operand is a script address
+    if struct.unpack_from("<H", data, offset + 9)[0] != 0:
+        return 11, (9,)
+    else:
+        return 11, _noReloc
 
-    elif op == Op.MOVE:
+def _decode23(data, offset):
+    if data[offset + 2] < 0x80:
+        return 9, _noReloc
+    else:
+        return 3, _noReloc
+
+_decoders = {
+    Op.MESSAGE: _decodeMessage,
+    Op.CALL:    _decodeTarget,
+    Op.JUMP:    _decodeTarget,
+    Op.BREAK:   _decodeTarget,
+    Op.WINDOW:  _decodeWindow,
+    Op.ASSIGN:  _decodeAssign,
+    Op.IF:      _decodeCondition,
+    Op.WHILE:   _decodeCondition,
+    0x0d:       _decode0d,
+    Op.WAIT:    _decodeWait,
+    Op.MOVE:    _decodeMove,
+    Op.VFX:     _decodeVfx,
+    Op.MENU:    _decodeMenu,
+    0x19:       _decode19,
+    0x1a:       _decode1a,
+    0x1d:       _decode19,
+    0x1f:       _decode1f,
+    Op.TIMER:   _decodeTimer,
+    0x23:       _decode23,
+}
+
+# Table of decoders indexed by opcode
+_opDecoders = [_decoders.get(op) for op in range(len(opcodes))]
+
+# Table of fixed lengths indexed by opcode
+_opLengths = [length for length, mnemonic in opcodes]
 
-        # Operand is terminated by 0xfe/0xff
-        end = offset + 3
-        while data[end] not in [0xfe, 0xff]:
-            end += 1
 
-        length = end - offset + 1
+#
+# Disassembly of instruction operands
+#
+# Each function takes the data bytes of an instruction, the game version and
+# the Kanji table, and returns the disassembled operands. Opcodes without a
+# formatter show their operand bytes in hex.
+#
 
-        disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
-
-    elif op == Op.VFX:
-
-        # Operand is variable
-        sel = data[offset + 1]
-
-        if sel == 0xf1:
-            length += 5
-        elif sel in [0xf4, 0xfd]:
-            length += 6
-        elif sel in [0xf5, 0xf6]:
-            length += 3
-        elif sel == 0xfb:
-            length += 2
-        elif sel == 0xff:
-            length += 8
-
-        disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
-
-    elif op == Op.MENU:
-
-        # Operands depend on menu type
-        sel = data[offset + 1]
-        disass += " " + hex(sel)
-
-        if sel == 0x01:
-            disass += " (memory card)"
-        elif sel == 0x02:
-            disass += " (name entry)"
-            length += 2
-        elif sel == 0x03:
-            disass += " (buy)"
-            end = data.index(b'\xff', offset)
-            length += end - offset - 1
-        elif sel == 0x04:
-            disass += " (sell)"
-        elif sel == 0x07:
-            disass += " (upgrade)"
-        elif sel == 0x08:
-            disass += " (create magic)"
-            length += 1
-        elif sel == 0x09:
-            disass += " (load/save)"
-            length += 1
-        elif sel == 0x0a:
-            disass += " (reload)"
-        elif sel == 0x0e:
-            disass += " (trial results)"
-        elif sel == 0xff:
-            disass += " (change)"
-
-        if length > 2:
-            disass += " " + " ".join(map(hex, data[offset + 2:offset + length]))
-
-    elif op == Op.EXEC:
-
-        # Operand is a pointer
-        p = struct.unpack_from("<L", data, offset + 1)
-        disass += " %08x" % p
-
-    elif op in [0x19, 0x1d]:
-
-        # Operand is variable
-        sel = data[offset + 3]
-
-        if sel == 0xff:
-            length += 3
-
-        disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
-
-    elif op == 0x1a:
-
-        # Operand is variable
-        sel = data[offset + 1]
-
-        if sel in [0xfe, 0xff]:
-            end = data.index(b'\xff\xff', offset + 2)
-            length = end - offset + 2
-        else:
-            end = data.index(b'\xff', offset + 2)
-            length = end - offset + 1
+def _hexBytes(data):
+    return " ".join(map(hex, data))
 
-        disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
+def _formatMessage(data, version, kanjiTable):
+    return wa.text.decode(data[1:-1], version, kanjiTable)
 
-    elif op == 0x1f:
+def _formatTarget(data, version, kanjiTable):
+    return "%04x" % struct.unpack_from("<H", data, 1)
 
-        # Operand is variable
-        sel = data[offset + 1]
+def _formatWindow(data, version, kanjiTable):
+    sel = data[1]
+    if sel == 3:
+        return "%d type %d, x/y = (%d, %d), w/h = (%d, %d)" % ((sel,) + struct.unpack_from("<5H", data, 2))
+    else:
+        return "%d" % sel
+
+def _formatAssign(data, version, kanjiTable):
+    return parseExpression(data, 1, True).format()
+
+def _formatCondition(data, version, kanjiTable):
+    expr = parseExpression(data, 1)
+    return expr.format() + (": (else jump %04x)" % struct.unpack_from("<H", data, 1 + expr.length))
+
+_menuTypes = {
+    0x01: "memory card",
+    0x02: "name entry",
+    0x03: "buy",
+    0x04: "sell",
+    0x07: "upgrade",
+    0x08: "create magic",
+    0x09: "load/save",
+    0x0a: "reload",
+    0x0e: "trial results",
+    0xff: "change",
+}
+
+def _formatMenu(data, version, kanjiTable):
+    sel = data[1]
+    s = hex(sel)
+
+    if sel in _menuTypes:
+        s += " (" + _menuTypes[sel] + ")"
+
+    if len(data) > 2:
+        s += " " + _hexBytes(data[2:])
+
+    return s
+
+def _formatExec(data, version, kanjiTable):
+    return "%08x" % struct.unpack_from("<L", data, 1)
+
+def _formatTimer(data, version, kanjiTable):
+    return "%02d:%02d %02d:%02d call %04x" % struct.unpack_from("<5H", data, 1)
+
+_formatters = {
+    Op.MESSAGE: _formatMessage,
+    Op.CALL:    _formatTarget,
+    Op.JUMP:    _formatTarget,
+    Op.BREAK:   _formatTarget,
+    Op.WINDOW:  _formatWindow,
+    Op.ASSIGN:  _formatAssign,
+    Op.IF:      _formatCondition,
+    Op.WHILE:   _formatCondition,
+    Op.MENU:    _formatMenu,
+    Op.EXEC:    _formatExec,
+    Op.TIMER:   _formatTimer,
+}
+
+
+# Disassemble an instruction given its opcode and data bytes, returning a
+# string.
+def disassemble(op, data, version, kanjiTable = None):
+    if op == Op.ENTRY:
+        return "entry %02x" % struct.unpack_from("<H", data)
+    elif op == Op.STRING:
+        return "string " + wa.text.decode(data[:-1], version, kanjiTable)
+    elif op == Op.PTR:
+        return "<PTR>"
+
+    mnemonic = opcodes[op][1]
+
+    if op in _formatters:
+        return mnemonic + " " + _formatters[op](data, version, kanjiTable)
+    elif len(data) > 1:
+        return mnemonic + " " + _hexBytes(data[1:])
+    else:
+        return mnemonic
 
-        if sel != 0:
-            length += 10
 
-        disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
+# Decode one instruction at the given offset in the data and return an
+# Instruction object. The disassembly of the instruction is created on
+# demand.
+def parseInstruction(data, offset, version, basePointer = mapBasePointer, kanjiTable = None):
 
-    elif op == Op.TIMER:
+    # Fetch opcode
+    op = data[offset]
 
-        minStart = struct.unpack_from("<H", data, offset + 1)[0]
-        secStart = struct.unpack_from("<H", data, offset + 3)[0]
-        minStop = struct.unpack_from("<H", data, offset + 5)[0]
-        secStop = struct.unpack_from("<H", data, offset + 7)[0]
+    # The linker used for building the game has the habit
+    # of inserting pointers to the current location in
+    # some places. We need to skip these.
+    p = struct.unpack_from("<L", data, offset)[0]
 
-        # Last operand is a script address
-        addr = struct.unpack_from("<H", data, offset + 9)[0]
+    if (offset % 4 == 0) and p == offset + 0x8014f000:
+        return Instruction(Op.PTR, 4, offsetToAddr(offset, basePointer), bytes(data[offset:offset + 4]))
 
-        disass += " %02d:%02d %02d:%02d call %04x" % (minStart, secStart, minStop, secStop, addr)
+    # Heuristic for detecting string literals embedded within the code.
+    # A more solid way would be to do a control flow analysis of the
+    # code, or to look for the "addr" expression opcodes which reference
+    # the strings.
+    if (op == 0x05) or (op > 0x28) or (p == 0x20202020) or \
+       ((op == 0x11) and (data[offset + 2] not in [0x00, 0xff])) or \
+       ((op == 0x20) and (data[offset + 1] >= 0x20)):
 
-        if addr != 0:
-            reloc.append(9)
+        end = data.index(b'\0', offset)
+        length = end - offset + 1
 
-    elif op == 0x23:
+        return Instruction(Op.STRING, length, offsetToAddr(offset, basePointer), bytes(data[offset:end + 1]), None, _noReloc, version, kanjiTable)
 
-        # Operand is variable
-        sel = data[offset + 2]
+    # Regular instruction
+    length, reloc = scanInstruction(data, offset)
 
-        if sel < 0x80:
-            length += 6
+    return Instruction(op, length, offsetToAddr(offset, basePointer), bytes(data[offset:offset + length]), None, reloc, version, kanjiTable)
 
-        disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
 
+# Decode the structure of a regular instruction at the given offset in the
+# data, returning the tuple (length, reloc).
+def scanInstruction(data, offset):
+    decoder = _opDecoders[data[offset]]
+    if decoder:
+        return decoder(data, offset)
     else:
-        if length > 1:
-            disass += " " + " ".join(map(hex, data[offset + 1:offset + length]))
-
-    return Instruction(op, length, offsetToAddr(offset, basePointer), data[offset:offset + length], disass, reloc)
+        return _opLengths[data[offset]], _noReloc
 
 
 # Recalculate all instruction addresses in a script to a new start address,
@@ -588,6 +922,29 @@ def fixupScript(script, addrMap):
     return script
 
 
+# Find the cross-references in a list of script instructions, returning a
+# dictionary which maps each referenced address to a list of (addr, kind)
+# tuples, with the address of the referring instruction and the kind of
+# reference, which is the mnemonic of a CALL, JUMP, BREAK, IF or WHILE
+# instruction, or "addr" for a script address in an expression.
+def findXrefs(script):
+    xrefs = {}
+
+    for instr in script:
+        if not instr.reloc or instr.op == Op.ENTRY:
+            continue
+
+        data = instr.bytes
+        targetOffset = instr.reloc[-1] if instr.op in _branchOps else None
+
+        for offset in instr.reloc:
+            target = struct.unpack_from("<H", data, offset)[0]
+            kind = opcodes[instr.op][1] if offset == targetOffset else "addr"
+            xrefs.setdefault(target, []).append((instr.addr, kind))
+
+    return xrefs
+
+
 # Convert a list of script instructions to binary data.
 def getScriptData(script):
     data = bytearray()
@@ -606,6 +963,210 @@ def align4(data):
         return data
 
 
+#
+# Relocation of the MIPS code in map data
+#
+# The MIPS's lack of 32-bit operands to instructions doesn't help here... :-(
+# Luckily, the instruction sequences generated by the compiler used by the
+# game's developers are quite regular.
+#
+
+MipsReloc = _enum(
+    POINTER = 0,  # 32-bit linear pointer
+    JUMP    = 1,  # 26-bit jump instruction operand
+    HILO    = 2,  # Upper 16 bits in first instruction, lower 16 bits (signed) in next instruction
+    HILO_2  = 4,  # Upper 16 bits in first instruction, lower 16 bits (signed) in instruction after the next one
+)
+
+# Opcode masks of load/store instructions
+_loadStoreOps = frozenset([
+    0x84000000,  # lh
+    0x8c000000,  # lw
+    0x90000000,  # lbu
+    0x94000000,  # lhu
+    0xa0000000,  # sb
+    0xa4000000,  # sh
+    0xac000000,  # sw
+])
+
+# Opcode masks of instructions following a 'lui' for loading a 32-bit
+# pointer or accessing data at a fixed address
+_hiLoOps = _loadStoreOps | frozenset([0x24000000])  # addiu
+
+# Cache of relocation sites found by findMipsRelocs()
+_mipsRelocCache = {}
+_mipsRelocCacheSize = 16
+
+
+# Find all references to the map's code and data in a block of MIPS code,
+# given the pointers to the start and end of the code. The block must be
+# followed by two extra words for examining instruction sequences at the end
+# of the code.
+#
+# Returns a list of (index, type, pointer) tuples, where 'index' is the
+# index of the instruction or data word in the block, 'type' is a MipsReloc
+# value, and 'pointer' is the combined pointer for the HILO types (and None
+# otherwise). Results are cached, so relocating the same code again only
+# costs applying the new delta.
+def findMipsRelocs(code, startPointer, endPointer):
+    key = (code, startPointer, endPointer)
+    try:
+        return _mipsRelocCache[key]
+    except KeyError:
+        pass
+
+    numWords = len(code) // 4 - 2
+    words = struct.unpack_from("<%dL" % (numWords + 2), code)
+
+    # Preselect all words which may need to be relocated; this is much
+    # faster than examining each word in detail
+    candidates = [i for i, w in enumerate(words[:numWords])
+                  if (startPointer <= w < endPointer) or
+                     (w & 0xf8000000) == 0x08000000 or
+                     (w & 0xfc00fffc) == 0x3c008014]
+
+    relocs = []
+
+    for i in candidates:
+        w = words[i]
+
+        if (w >= startPointer) and w < (endPointer):
+
+            # Regular pointer, for example in a jump table or in the
+            # global vector
+            relocs.append((i, MipsReloc.POINTER, None))
+
+        elif (w & 0xf8000000) == 0x08000000:
+
+            # Jump instruction (j/jal) with 26-bit operand
+            a = ((w & 0x03ffffff) << 2) | 0x80000000
+            if a >= startPointer and a <= endPointer:
+                relocs.append((i, MipsReloc.JUMP, None))
+
+        else:
+
+            # First instruction is 'lui rx, 0x8014..0x8017'; examine the
+            # next two instructions
+            w2, w3 = words[i + 1], words[i + 2]
+
+            if (w2 & 0xfc000000) in _hiLoOps:
+
+                # Sequence is 'lui + addiu' for loading a 32-bit pointer, or
+                # 'lui + load/store' for accessing data at a fixed address
+                relocType = MipsReloc.HILO
+                lo = w2 & 0xffff
+
+            elif (w2 & 0xfc000000) == 0x34000000:
+
+                # Sequence is 'lui + ori' for loading a 32-bit pointer
+                # (never used for references withing the code, only for
+                # fixed addresses like the start of the map graphics)
+                continue
+
+            elif (w2 & 0xfc0007ff) == 0x00000021 and (w3 & 0xfc000000) in _loadStoreOps:
+
+                # Sequence is 'lui + addu + load/store' for indexing an array
+                relocType = MipsReloc.HILO_2
+                lo = w3 & 0xffff
+
+            else:
+                raise ValueError("Unrecognized MIPS instruction sequence %08x %08x %08x" % (w, w2, w3))
+
+            # Combine the split pointer
+            if lo >= 0x8000:
+                lo -= 0x10000
+
+            p = ((w & 0xffff) << 16) + lo
+            if (p >= startPointer) and (p <= mapGfxPointer):
+                relocs.append((i, relocType, p))
+
+    if len(_mipsRelocCache) >= _mipsRelocCacheSize:
+        _mipsRelocCache.clear()
+
+    _mipsRelocCache[key] = relocs
+    return relocs
+
+
+# Relocate a block of MIPS code (a bytearray, followed by two extra words)
+# in place by adding 'deltaOffset' to all references given by the list of
+# relocation sites returned by findMipsRelocs().
+def relocateMipsCode(code, relocs, deltaOffset):
+    words = array.array("I")
+    words.frombytes(code)
+    if sys.byteorder != "little":
+        words.byteswap()
+
+    deltaJump = deltaOffset // 4
+
+    for i, relocType, p in relocs:
+        w = words[i]
+
+        if relocType == MipsReloc.POINTER:
+
+            # Stuff in the new pointer
+            words[i] = w + deltaOffset
+
+        elif relocType == MipsReloc.JUMP:
+
+            # Stuff in the new operand
+            words[i] = (w & 0xfc000000) | ((w & 0x03ffffff) + deltaJump)
+
+        else:
+
+            # Adjust the pointer, and write back the hi/lo halves
+            p += deltaOffset
+
+            hi = p >> 16
+            lo = p & 0xffff
+            if lo >= 0x8000:
+                hi += 1  # adding a negative lower part will decrement the upper part
+
+            words[i] = (w & 0xffff0000) | hi
+
+            j = i + 1 if relocType == MipsReloc.HILO else i + 2
+            words[j] = (words[j] & 0xffff0000) | lo
+
+    if sys.byteorder != "little":
+        words.byteswap()
+
+    code[:] = words.tobytes()
+
+
+# Find the range of bytes which differ between two versions of data,
+# returning the tuple (start, end), or None if the data is identical. If the
+# data differs in size, the range extends to the end of the longer one.
+def changedRange(oldData, newData):
+    old = memoryview(oldData)
+    new = memoryview(newData)
+
+    size = min(len(old), len(new))
+    chunkSize = 4096
+
+    # Skip identical data at the start, first in chunks and then byte by byte
+    start = 0
+    while start < size and old[start:start + chunkSize] == new[start:start + chunkSize]:
+        start += chunkSize
+
+    start = min(start, size)
+    while start < size and old[start] == new[start]:
+        start += 1
+
+    if len(old) != len(new):
+        return (start, max(len(old), len(new)))
+    elif start == size:
+        return None
+
+    # Skip identical data at the end
+    end = size
+    while end - chunkSize > start and old[end - chunkSize:end] == new[end - chunkSize:end]:
+        end -= chunkSize
+
+    while old[end - 1] == new[end - 1]:
+        end -= 1
+
+    return (start, end)
+
+
 # Map data section indexes
 Section = _enum(
     ACTOR       =  5,
@@ -624,15 +1185,42 @@ Section = _enum(
 class MapData:
 
     # Create a MapData object from a binary data block.
-    def __init__(self, mapBlock, mapNumber, version):
+    def __init__(self, mapBlock, mapNumber, version, cache = None):
         self.version = version
         self.mapNumber = mapNumber
 
+        # Optional wa.cache.ScriptCache for parsed data
+        self.cache = cache
+
+        # Range (start, end) of the data which was changed since the map
+        # was loaded or last written back, or None if unchanged
+        self.dirty = None
+
         self.setData(mapBlock)
 
-    # Set the binary map data.
+    # Mark a range of the map data as changed.
+    def markDirty(self, start, end):
+        if start >= end:
+            return
+
+        if self.dirty is None:
+            self.dirty = (start, end)
+        else:
+            self.dirty = (min(self.dirty[0], start), max(self.dirty[1], end))
+
+    # Set the binary map data. A bytearray is used directly, other objects
+    # are copied. The data may be truncated to the part before the graphics
+    # data at offset 0x15000, which contains everything needed for handling
+    # scripts and text.
     def setData(self, mapBlock):
-        self.data = bytearray(mapBlock)
+        if isinstance(mapBlock, bytearray):
+            self.data = mapBlock
+        else:
+            self.data = bytearray(mapBlock)
+
+        # Cache key and records for the data, loaded on demand
+        self._cacheKey = None
+        self._cacheRecords = None
 
         # Extract the pointer table at the start and convert the pointers
         # to offsets
@@ -690,6 +1278,43 @@ class MapData:
         if len(self.kanjiBitmap) % 22:
             self.kanjiBitmap = self.kanjiBitmap[:-(len(self.kanjiBitmap) % 22)]
 
+        # Create the Kanji table used for decoding the map's text
+        if wa.version.isJapanese(self.version):
+            self.kanjiTable = wa.text.KanjiTable(self.kanjiBitmap)
+        else:
+            self.kanjiTable = None
+
+    # Return the cache records for the map data as a dictionary of record
+    # type to list of payloads, or None if no cache is used.
+    def _getCacheRecords(self):
+        if self.cache is None:
+            return None
+
+        if self._cacheRecords is None:
+            self._cacheKey = self.cache.getKey(self.data, self.mapNumber, self.version)
+            self._cacheRecords = self.cache.load(self._cacheKey)
+
+        return self._cacheRecords
+
+    # Add a record to the cache for the map data.
+    def _addCacheRecord(self, recordType, payload):
+        records = self._getCacheRecords()
+        if records is not None:
+            records.setdefault(recordType, []).append(payload)
+            self.cache.save(self._cacheKey, records)
+
+    # Return the data of a section as a memoryview, without copying it. The
+    # section extends up to the start of the next section. Returns None for
+    # sections which are not present in the map.
+    def getSection(self, section):
+        if not self.pointers[section]:
+            return None
+
+        start = self.offsets[section]
+        end = min([o for p, o in zip(self.pointers, self.offsets) if p and o > start] + [len(self.data)])
+
+        return memoryview(self.data)[start:max(start, end)]
+
     # Extract an entry table from the given offset range.
     def _extractEntries(self, offset, endOffset):
         numEntries = (endOffset - offset) // 2
@@ -710,23 +1335,67 @@ class MapData:
         else:
             return self._extractEntries(self.script2Start, self.script2FirstInstr)
 
+    # Return a dictionary which maps each address in the entry tables to a
+    # list of (table, index) tuples, where 'table' is 0 for the script entry
+    # table, and 1 or 2 for the entry tables of the script sections.
+    def getEntryIndex(self):
+        index = {}
+
+        for table, entries in enumerate([self.getGlobalEntries(), self.getScript1Entries(), self.getScript2Entries()]):
+            for i, addr in enumerate(entries):
+                index.setdefault(addr, []).append((table, i))
+
+        return index
+
+    # Return the cross-references in the scripts, as described for
+    # findXrefs(). The scripts are extracted if they are not given.
+    def getXrefs(self, script1 = None, script2 = None):
+        if script1 is None:
+            script1 = self.getScript1()
+        if script2 is None:
+            script2 = self.getScript2()
+
+        return findXrefs(script1 + script2)
+
     # Extract script code from the given offset range.
     def extractScript(self, offset, firstInstr, endOffset):
         script = []
 
+        # The instructions get compact bytes objects of their own data, so
+        # only the data of each instruction is copied
+        data = self.data
+
         # Decode the entry table
         while offset < firstInstr:
-            target = struct.unpack_from("<H", self.data, offset)[0]
-            instr = Instruction(Op.ENTRY, 2, offsetToAddr(offset), self.data[offset:offset + 2], "entry %02x" % target, [0])
+            instr = Instruction(Op.ENTRY, 2, offsetToAddr(offset), bytes(data[offset:offset + 2]), None, _entryReloc)
             script.append(instr)
             offset += 2
 
+        # Use the cached instruction structure if available, to avoid
+        # decoding the instructions
+        records = self._getCacheRecords()
+
+        if records:
+            for payload in records.get(wa.cache.Record.SCRIPT, []):
+                if struct.unpack_from("<3L", payload) == (offset, firstInstr, endOffset):
+                    for op, length, reloc in wa.cache.decodeScript(payload)[3]:
+                        script.append(Instruction(op, length, offsetToAddr(offset), bytes(data[offset:offset + length]), None, reloc, self.version, self.kanjiTable))
+                        offset += length
+
+                    return script
+
         # Decode the instructions
+        start = offset
+
         while offset < endOffset:
-            instr = parseInstruction(self.data, offset, self.version, mapBasePointer, self.kanjiBitmap)
+            instr = parseInstruction(data, offset, self.version, mapBasePointer, self.kanjiTable)
             script.append(instr)
             offset += instr.length
 
+        if records is not None:
+            instrs = [(instr.op, instr.length, instr.reloc) for instr in script if instr.op != Op.ENTRY]
+            self._addCacheRecord(wa.cache.Record.SCRIPT, wa.cache.encodeScript(start, firstInstr, endOffset, instrs))
+
         return script
 
     # Extract the first script section as a list of Instruction objects.
@@ -743,6 +1412,10 @@ class MapData:
     # Find the start and end of the MIPS code in the map data and return the
     # tuple (startOffset, endOffset).
     def _findMipsCode(self):
+        records = self._getCacheRecords()
+
+        if records and wa.cache.Record.MIPS_CODE in records:
+            return struct.unpack("<LL", records[wa.cache.Record.MIPS_CODE][0])
 
         # Finding the start of the code is somewhat tricky as there is no
         # direct section pointer to it.
@@ -783,8 +1456,27 @@ class MapData:
         # enough for us)
         endOffset = struct.unpack_from("<L", self.data, 0x0c)[0]
 
+        if records is not None:
+            self._addCacheRecord(wa.cache.Record.MIPS_CODE, struct.pack("<LL", startOffset, endOffset))
+
         return startOffset, endOffset
 
+    # Find the references in the MIPS code which need to be relocated,
+    # returning the list of relocation sites from findMipsRelocs().
+    def _findMipsRelocs(self, exeStart, exeEnd, codeSize):
+        records = self._getCacheRecords()
+
+        if records and wa.cache.Record.MIPS_RELOC in records:
+            return wa.cache.decodeMipsRelocs(records[wa.cache.Record.MIPS_RELOC][0])
+
+        code = bytes(self.data[exeStart:exeStart + codeSize + 8])
+        relocs = findMipsRelocs(code, offsetToPointer(exeStart), offsetToPointer(exeEnd))
+
+        if records is not None:
+            self._addCacheRecord(wa.cache.Record.MIPS_RELOC, wa.cache.encodeMipsRelocs(relocs))
+
+        return relocs
+
     # Get a list of the strings in the MIPS code.
     def getCodeStrings(self):
         strings = []
@@ -808,8 +1500,16 @@ class MapData:
         script1 = [instr for instr in script1 if instr.op != Op.PTR]
         script2 = [instr for instr in script2 if instr.op != Op.PTR]
 
+        # The new data block is built in a buffer of the same size as the
+        # old one, in which all data is placed at its final position
+        oldData = memoryview(self.data)
+        newData = bytearray(len(self.data))
+        view = memoryview(newData)
+
+        gfxStart = mapGfxOffset
+
         # Copy all data preceding the entry table
-        newData = self.data[0:self.entryTableStart]
+        view[0:self.entryTableStart] = oldData[0:self.entryTableStart]
 
         # Set the new starting addresses of the script sections
         script1, addrMap = recalcScriptAddr(script1, offsetToAddr(self.script1Start))
@@ -827,191 +1527,51 @@ class MapData:
             script2, addrMap2 = recalcScriptAddr(script2, offsetToAddr(self.script2Start))
             addrMap.update(addrMap2)
 
-        # Create a new, relocated entry table and append it
+        # Create a new, relocated entry table
         entries = self.getGlobalEntries()
-        entryData = bytearray()
-
-        for e in entries:
-            try:
-                newAddr = addrMap[e]
-            except KeyError:
-                newAddr = 0  # unused entry
-            entryData.extend(struct.pack("<H", newAddr))
 
-        newData.extend(entryData)
+        struct.pack_into("<%dH" % len(entries), newData, self.entryTableStart, *[addrMap.get(e, 0) for e in entries])  # 0 = unused entry
+        offset = self.entryTableStart + len(entries) * 2
 
-        # Relocate and append the first script section
-        assert(len(newData) == self.script1Start)
+        # Relocate and insert the script sections, each followed by a bogus
+        # pointer before the next section
+        assert(offset == self.script1Start)
 
         script1 = fixupScript(script1, addrMap)
-        newData.extend(getScriptData(script1))
-        newData = align4(newData)
+        offset = self._insertScript(view, offset, script1)
 
-        # Add bogus pointer before next section
-        newData += struct.pack("<L", offsetToPointer(len(newData)))
-
-        # Relocate and append the second script section
         if script2:
-            assert(len(newData) == self.script2Start)
+            assert(offset == self.script2Start)
 
             script2 = fixupScript(script2, addrMap)
-            newData.extend(getScriptData(script2))
-            newData = align4(newData)
-
-            self.script2End = len(newData)
+            offset = self._insertScript(view, offset, script2)
 
-            # Add bogus pointer before next section
-            newData += struct.pack("<L", offsetToPointer(len(newData)))
+            self.script2End = offset - 4
 
         # Copy all following data up to the graphics at constant offset 0x15000
-        assert(len(newData) % 4 == 0)
-
-        gfxStart = 0x15000
+        assert(offset % 4 == 0)
 
         start = min(self.offsets[Section.MUSIC_TABLE], self.offsets[Section.KANJI])
-        deltaOffset = len(newData) - start  # correction value for pointers and offsets due to changed script size
-
-        newData.extend(self.data[start:gfxStart])
-        if len(newData) > gfxStart:
-            newData = newData[:gfxStart]
-        elif len(newData) < gfxStart:
-            newData.extend(bytearray(gfxStart - len(newData)))
+        deltaOffset = offset - start  # correction value for pointers and offsets due to changed script size
 
-        assert(len(newData) == gfxStart)
+        size = min(gfxStart - start, gfxStart - offset)
+        view[offset:offset + size] = oldData[start:start + size]
 
-        # Find the start and end of the MIPS code in the original data
+        # Find the start and end of the MIPS code in the original data, and
+        # the references within it which need to be relocated
         exeStart, exeEnd = self._findMipsCode()
 
-        # Relocate the code in the new data block. The MIPS's lack of 32-bit
-        # operands to instructions doesn't help here... :-(
-        # Luckily, the instruction sequences generated by the compiler used
-        # by the game's developers are quite regular.
-        startPointer = offsetToPointer(exeStart)
-        endPointer = offsetToPointer(exeEnd)
-
-        Reloc = _enum(
-            POINTER = 0,  # 32-bit linear pointer
-            JUMP    = 1,  # 26-bit jump instruction operand
-            HILO    = 2,  # Upper 16 bits in first instruction, lower 16 bits (signed) in next instruction
-            HILO_2  = 4,  # Upper 16 bits in first instruction, lower 16 bits (signed) in instruction after the next one
-        )
+        codeSize = (exeEnd - exeStart + 3) & ~3
+        relocs = self._findMipsRelocs(exeStart, exeEnd, codeSize)
 
+        # Relocate the code in the new data block
         exeStart += deltaOffset
         exeEnd += deltaOffset
 
         if exeEnd > gfxStart:
             raise IndexError("Map data overrun")
 
-        offset = exeStart
-        while offset < exeEnd:
-
-            # Read the next three instructions or data words
-            w, w2, w3 = struct.unpack_from("<3L", newData, offset)
-
-            relocType = None
-
-            if (w >= startPointer) and w < (endPointer):
-
-                # Regular pointer, for example in a jump table or in the
-                # global vector
-                relocType = Reloc.POINTER
-
-            elif (w & 0xfc000000) in [0x08000000,   # j
-                                      0x0c000000]:  # jal
-
-                # Jump instruction with 26-bit operand
-                a = ((w & 0x03ffffff) << 2) | 0x80000000
-                if a >= startPointer and a <= endPointer:
-                    relocType = Reloc.JUMP
-
-            elif (w & 0xfc00fffc) == 0x3c008014:
-
-                # First instruction is 'lui rx, 0x8014..0x8017'; examine the
-                # next two instructions
-                if (w2 & 0xfc000000) in [0x24000000,   # addiu
-                                         0x84000000,   # lh
-                                         0x8c000000,   # lw
-                                         0x90000000,   # lbu
-                                         0x94000000,   # lhu
-                                         0xa0000000,   # sb
-                                         0xa4000000,   # sh
-                                         0xac000000]:  # sw
-
-                    # Sequence is 'lui + addiu' for loading a 32-bit
-                    # pointer, or 'lui + load/store' for accessing data
-                    # at a fixed address
-                    relocType = Reloc.HILO
-
-                elif (w2 & 0xfc000000) == 0x34000000:
-
-                    # Sequence is 'lui + ori' for loading a 32-bit pointer
-                    # (never used for references withing the code, only for
-                    # fixed addresses like the start of the map graphics)
-                    relocType = None
-
-                elif (w2 & 0xfc0007ff) == 0x00000021:  # addu
-
-                    if (w3 & 0xfc000000) in [0x84000000,   # lh
-                                             0x8c000000,   # lw
-                                             0x90000000,   # lbu
-                                             0x94000000,   # lhu
-                                             0xa0000000,   # sb
-                                             0xa4000000,   # sh
-                                             0xac000000]:  # sw
-
-                        # Sequence is 'lui + addu + load/store' for indexing
-                        # an array
-                        relocType = Reloc.HILO_2
-
-                    else:
-                        raise ValueError("Unrecognized MIPS instruction sequence %08x %08x %08x" % (w, w2, w3))
-
-                else:
-                    raise ValueError("Unrecognized MIPS instruction sequence %08x %08x %08x" % (w, w2, w3))
-
-            if relocType == Reloc.POINTER:
-
-                # Stuff in the new pointer
-                n = w + deltaOffset
-                struct.pack_into("<L", newData, offset, n)
-
-            elif relocType == Reloc.JUMP:
-
-                # Stuff in the new operand
-                n = (w & 0xfc000000) | ((w & 0x03ffffff) + (deltaOffset // 4))
-                struct.pack_into("<L", newData, offset, n)
-
-            elif relocType == Reloc.HILO:
-
-                # Combine the split pointer, adjust it, and write back the hi/lo halves
-                p = ((w & 0xffff) << 16) + struct.unpack_from("<h", newData, offset + 4)[0]
-                if (p >= startPointer) and (p <= mapGfxPointer):
-                    p += deltaOffset
-
-                    hi = p >> 16
-                    lo = p & 0xffff
-                    if lo >= 0x8000:
-                        hi += 1  # adding a negative lower part will decrement the upper part
-
-                    struct.pack_into("<H", newData, offset, hi)
-                    struct.pack_into("<H", newData, offset + 4, lo)
-
-            elif relocType == Reloc.HILO_2:
-
-                # Combine the split pointer, adjust it, and write back the hi/lo halves
-                p = ((w & 0xffff) << 16) + struct.unpack_from("<h", newData, offset + 8)[0]
-                if (p >= startPointer) and (p <= mapGfxPointer):
-                    p += deltaOffset
-
-                    hi = p >> 16
-                    lo = p & 0xffff
-                    if lo >= 0x8000:
-                        hi += 1  # adding a negative lower part will decrement the upper part
-
-                    struct.pack_into("<H", newData, offset, hi)
-                    struct.pack_into("<H", newData, offset + 8, lo)
-
-            offset += 4
+        relocateMipsCode(view[exeStart:exeStart + codeSize + 8], relocs, deltaOffset)
 
         # Insert the strings in the MIPS code
         if codeStrings:
@@ -1069,7 +1629,363 @@ class MapData:
             struct.pack_into("<L", newData, offset, p + deltaOffset)
 
         # Copy graphics and sound data
-        newData.extend(self.data[0x15000:])
+        view[gfxStart:] = oldData[gfxStart:]
+
+        # Set the new data block, keeping track of the changed range
+        changed = changedRange(oldData, newData)
+        if changed:
+            self.markDirty(*changed)
 
-        # Set the new data block
         self.setData(newData)
+
+    # Insert the binary data of a script section into a map data block,
+    # given as a memoryview, followed by a bogus pointer to the next
+    # section. Returns the offset after the pointer.
+    def _insertScript(self, view, offset, script):
+        size = sum(len(instr.bytes) for instr in script)
+        end = ((offset + size + 3) & ~3) + 4  # align to 32-bit boundary, the padding is already zero
+
+        if end > mapGfxOffset:
+            raise IndexError("Map data overrun")
+
+        for instr in script:
+            view[offset:offset + len(instr.bytes)] = instr.bytes
+            offset += len(instr.bytes)
+
+        struct.pack_into("<L", view, end - 4, offsetToPointer(end - 4))
+        return end
+
+
+# Object providing random access to the map data blocks in CDSTG.BIN.
+class MapStore:
+
+    # Create a MapStore for the given GameImage or GameDirectory. If
+    # 'mapFile' is specified, it must be a file object of CDSTG.BIN opened
+    # for updating, which is used for reading and writing instead. If a
+    # wa.cache.ScriptCache is given, it is used by the MapData objects for
+    # caching parsed data.
+    def __init__(self, image, mapFile = None, cache = None):
+        self.image = image
+        self.version = image.version
+        self.file = mapFile
+        self.cache = cache
+
+        # List of the numbers of all valid maps
+        self.mapNumbers = [n for n in range(numMaps) if n not in dummyMaps]
+
+        # Block prefetched by processMaps() as a tuple (mapNumber, buffer,
+        # error), or None
+        self.prefetched = None
+
+    # Close the underlying file.
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    # Reopen the underlying files in a process created by fork(), so it has
+    # its own file positions. The map file is reopened read-only.
+    def reopen(self):
+        self.image.reopen()
+
+        if self.file is not None:
+            self.file = open(self.file.name, "rb")
+
+    # Read the data block of a map, returning a bytearray. Unless 'graphics'
+    # is true, only the part of the block before the graphics data is read.
+    def readBlock(self, mapNumber, graphics = False):
+        if mapNumber < 0 or mapNumber >= numMaps:
+            raise IndexError("Invalid map number %d" % mapNumber)
+
+        offset = mapNumber * mapBlockSize
+        size = mapBlockSize if graphics else mapGfxOffset
+
+        # Use the prefetched block if available
+        if not graphics and self.prefetched is not None and self.prefetched[0] == mapNumber:
+            mapNumber, buffer, error = self.prefetched
+            if error is not None:
+                raise error
+
+            return bytearray(buffer)
+
+        if self.file is not None:
+            data = bytearray(size)
+
+            self.file.seek(offset)
+            if self.file.readinto(data) < size:
+                raise EnvironmentError("Error reading map %d from CDSTG.BIN" % mapNumber)
+
+            return data
+
+        else:
+            return bytearray(self.image.readFilePart("BIN", "CDSTG.BIN", offset, size))
+
+    # Read a map, returning a MapData object. Unless 'graphics' is true, the
+    # map data only contains the part of the block before the graphics data.
+    def readMap(self, mapNumber, graphics = False):
+        return MapData(self.readBlock(mapNumber, graphics), mapNumber, self.version, self.cache)
+
+    # Add the Kanji glyphs of all maps which are known via their hash to the
+    # index used for matching unknown Kanji characters. This only has an
+    # effect in the Japanese version, and must be done before processing
+    # the maps.
+    def addKanjiGlyphs(self):
+        if wa.version.isJapanese(self.version):
+            for mapNumber in self.mapNumbers:
+                wa.text.addKanjiGlyphs(self.readMap(mapNumber).kanjiBitmap)
+
+    # Return the changed part of a MapData object as a tuple (mapNumber,
+    # offset, data) to be passed to writeChanges(), or None if the map was
+    # not changed. The MapData object is marked as unchanged.
+    def getChanges(self, mapData):
+        if len(mapData.data) > mapBlockSize:
+            raise IndexError("Data of map %d too large" % mapData.mapNumber)
+
+        if mapData.dirty is None:
+            return None
+
+        start, end = mapData.dirty
+        end = min(end, len(mapData.data))
+
+        mapData.dirty = None
+        return (mapData.mapNumber, start, bytes(memoryview(mapData.data)[start:end]))
+
+    # Write changes obtained from getChanges() to the map file. Returns the
+    # number of bytes written.
+    def writeChanges(self, changes):
+        if self.file is None:
+            raise EnvironmentError("Map data is read-only")
+
+        if changes is None:
+            return 0
+
+        mapNumber, offset, data = changes
+
+        self.file.seek(mapNumber * mapBlockSize + offset)
+        self.file.write(data)
+
+        return len(data)
+
+    # Write the changes to a MapData object back to its data block. Only the
+    # changed range of the data is written. Returns the number of bytes
+    # written, which is 0 if the map was not changed.
+    def writeMap(self, mapData):
+        if self.file is None:
+            raise EnvironmentError("Map data is read-only")
+
+        return self.writeChanges(self.getChanges(mapData))
+
+    # Process maps with a function which is called with the MapStore and a
+    # map number, and may return any picklable result. Returns an iterator
+    # over the tuples (mapNumber, result) in the order of 'mapNumbers',
+    # which defaults to all valid maps.
+    #
+    # If 'jobs' is larger than 1, the maps are processed in parallel by a
+    # pool of worker processes. The workers are created by fork(), so they
+    # inherit the function and the state of the program, and read the map
+    # data through their own handles of the map file instead of having the
+    # blocks sent to them. Workers can not write to the map file; changes
+    # must be returned to the caller with getChanges(). On systems without
+    # fork(), the maps are always processed sequentially.
+    #
+    # The worker processes are created when processMaps() is called, not
+    # when the iteration starts. Forking a process with more than one
+    # thread is unsafe, so this must be done before any helper threads
+    # like WriteBehind are started.
+    def processMaps(self, function, mapNumbers = None, jobs = 1):
+        global _workerStore, _workerFunction
+
+        if mapNumbers is None:
+            mapNumbers = self.mapNumbers
+
+        if jobs <= 1 or len(mapNumbers) <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            return self._processMapsSequentially(function, mapNumbers)
+
+        # Buffered output would otherwise be duplicated by the workers
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        _workerStore = self
+        _workerFunction = function
+
+        try:
+            context = multiprocessing.get_context("fork")
+            pool = context.Pool(min(jobs, len(mapNumbers)), _initWorker)
+        except:
+            _workerStore = None
+            _workerFunction = None
+            raise
+
+        return self._processMapsInPool(pool, mapNumbers)
+
+    # Yield the results of processing maps in a pool of worker processes
+    # created by processMaps().
+    def _processMapsInPool(self, pool, mapNumbers):
+        global _workerStore, _workerFunction
+
+        try:
+            with pool:
+                yield from zip(mapNumbers, pool.imap(_processMapInWorker, mapNumbers))
+        finally:
+            _workerStore = None
+            _workerFunction = None
+
+
+    # Process maps in the current process, reading the block of the next
+    # map in the background while the function processes the current one.
+    def _processMapsSequentially(self, function, mapNumbers):
+        if len(mapNumbers) <= 1:
+            for mapNumber in mapNumbers:
+                yield mapNumber, function(self, mapNumber)
+            return
+
+        prefetcher = _MapPrefetcher(self, mapNumbers)
+
+        try:
+            for mapNumber in mapNumbers:
+                self.prefetched = prefetcher.get()
+                assert(self.prefetched[0] == mapNumber)
+
+                result = function(self, mapNumber)
+
+                prefetcher.release(self.prefetched[1])
+                self.prefetched = None
+
+                yield mapNumber, result
+        finally:
+            self.prefetched = None
+            prefetcher.close()
+
+
+# Background thread which reads the data blocks of a list of maps in order
+# into a set of reusable buffers, ahead of their use by MapStore. The
+# part of the blocks before the graphics data is read.
+class _MapPrefetcher:
+    def __init__(self, mapStore, mapNumbers, numBuffers = 2):
+
+        # The thread uses its own handles of the files, so it does not
+        # interfere with the file positions of the main thread
+        self.image = None
+        self.file = None
+
+        if mapStore.file is not None:
+            self.file = open(mapStore.file.name, "rb")
+        elif isinstance(mapStore.image, wa.GameDirectory):
+            self.file = mapStore.image.openFile("BIN", "CDSTG.BIN")
+        else:
+            self.image = copy.copy(mapStore.image)
+            self.image.reopen()
+
+        self.filled = queue.Queue()
+        self.free = queue.Queue()
+        for i in range(numBuffers):
+            self.free.put(bytearray(mapGfxOffset))
+
+        self.thread = threading.Thread(target = self._run, args = (list(mapNumbers),), daemon = True)
+        self.thread.start()
+
+    # Main function of the thread.
+    def _run(self, mapNumbers):
+        for mapNumber in mapNumbers:
+            buffer = self.free.get()
+            if buffer is None:
+                break  # closed
+
+            error = None
+            try:
+                self._read(mapNumber, buffer)
+            except Exception as e:
+                error = e
+
+            self.filled.put((mapNumber, buffer, error))
+
+    # Read the block of a map into a buffer.
+    def _read(self, mapNumber, buffer):
+        offset = mapNumber * mapBlockSize
+
+        if self.file is not None:
+            self.file.seek(offset)
+            if self.file.readinto(buffer) < len(buffer):
+                raise EnvironmentError("Error reading map %d from CDSTG.BIN" % mapNumber)
+        else:
+            buffer[:] = self.image.readFilePart("BIN", "CDSTG.BIN", offset, len(buffer))
+
+    # Wait for the next block, returning the tuple (mapNumber, buffer,
+    # error). If reading the block failed, 'error' is the exception raised.
+    def get(self):
+        return self.filled.get()
+
+    # Return a buffer obtained from get() for reuse.
+    def release(self, buffer):
+        self.free.put(buffer)
+
+    # Stop the thread and close the files.
+    def close(self):
+        self.free.put(None)
+        self.thread.join()
+
+        if self.file is not None:
+            self.file.close()
+        if self.image is not None:
+            self.image.close()
+
+
+# Background thread which performs output operations in order, so writing
+# the results of one map overlaps with processing the next one.
+class WriteBehind:
+
+    # Create the thread. Submitting operations blocks when 'maxPending'
+    # operations are waiting.
+    def __init__(self, maxPending = 4):
+        self.queue = queue.Queue(maxPending)
+        self.error = None
+
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    # Main function of the thread.
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            # Skip all operations after an error
+            if self.error is None:
+                function, args = item
+                try:
+                    function(*args)
+                except Exception as e:
+                    self.error = e
+
+    # Queue a call of a function with the given arguments. Raises the
+    # exception of a previously failed operation.
+    def submit(self, function, *args):
+        if self.error is not None:
+            raise self.error
+
+        self.queue.put((function, args))
+
+    # Wait for all queued operations to finish and stop the thread. Raises
+    # the exception of a failed operation.
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+        if self.error is not None:
+            raise self.error
+
+
+# State of the worker processes of MapStore.processMaps(), which is
+# inherited from the parent process
+_workerStore = None
+_workerFunction = None
+
+
+# Initialize a worker process of MapStore.processMaps().
+def _initWorker():
+    _workerStore.reopen()
+
+
+# Process a map in a worker process of MapStore.processMaps().
+def _processMapInWorker(mapNumber):
+    return _workerFunction(_workerStore, mapNumber)
@@ -0,0 +1,254 @@
+#
+# wa.stage - Scheduling of the stages of a tool run
+#
+# Copyright (C) Christian Bauer <www.cebix.net>
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+
+import multiprocessing
+import multiprocessing.connection
+import sys
+import time
+
+
+#
+# The tools work in stages, like translating the executable or the maps,
+# which mostly use different game files. Each stage declares the files it
+# reads and writes. A stage depends on all earlier stages which write a file
+# it reads or writes, or which read a file it writes, and on the stages it
+# is explicitly declared to run after. Independent stages can run at the
+# same time.
+#
+# The stages are Python code, so they are run in separate processes created
+# by fork() instead of threads. They inherit the state of the program, but
+# changes they make to it are not visible to the parent process or to other
+# stages.
+#
+# A stage can itself run worker processes, like the stage which processes
+# the maps. It is given the jobs which are left over by the other stages,
+# so the number of processes doing work at the same time doesn't exceed
+# the number of jobs of the run.
+#
+
+
+# Object describing a stage.
+#
+# Attributes:
+#   name     = name of the stage
+#   function = function to call
+#   args     = tuple of the arguments of the function
+#   reads    = set of the names of the files read by the stage
+#   writes   = set of the names of the files written by the stage
+#   after    = set of the names of the stages which must finish first
+#   done     = function called in the parent process with the return value
+#              of 'function' after the stage finished successfully, or None
+#   parallel = true if the stage runs worker processes of its own, in which
+#              case the number of jobs it may use is passed to 'function'
+#              as the keyword argument 'jobs'
+class Stage:
+    __slots__ = ("name", "function", "args", "reads", "writes", "after", "done", "parallel")
+
+    def __init__(self, name, function, args, reads, writes, after, done, parallel):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.reads = reads
+        self.writes = writes
+        self.after = after
+        self.done = done
+        self.parallel = parallel
+
+    # Call the function of the stage, which may use the given number of
+    # jobs if it is a parallel stage, and return its result.
+    def call(self, jobs):
+        if self.parallel:
+            return self.function(*self.args, jobs = jobs)
+        else:
+            return self.function(*self.args)
+
+    def __repr__(self):
+        return "<Stage %s>" % self.name
+
+
+# Scheduler for running a set of stages in the order given by their
+# dependencies.
+class Scheduler:
+    def __init__(self):
+        self.stages = []
+
+        # Dictionary of stage name to running time in seconds
+        self.times = {}
+
+    # Add a stage which calls a function with the given tuple of arguments.
+    # 'reads' and 'writes' are lists of the names of the files used by the
+    # stage, 'after' a list of the names of earlier stages it must run
+    # after, and 'done' an optional function to call in the parent process
+    # with the return value of the function when the stage has finished.
+    # The return value must be picklable. If 'parallel' is true, the stage
+    # runs worker processes of its own, and the function is called with the
+    # number of jobs left over by the other stages as the keyword argument
+    # 'jobs'.
+    def add(self, name, function, args = (), reads = (), writes = (), after = (), done = None, parallel = False):
+        if any(stage.name == name for stage in self.stages):
+            raise ValueError("Duplicate stage '%s'" % name)
+
+        for other in after:
+            if not any(stage.name == other for stage in self.stages):
+                raise ValueError("Stage '%s' must run after unknown stage '%s'" % (name, other))
+
+        self.stages.append(Stage(name, function, tuple(args), set(reads), set(writes), set(after), done, parallel))
+
+    # Return a dictionary which maps the name of each stage to the set of
+    # the names of the stages it depends on.
+    def getDependencies(self):
+        deps = {}
+
+        for i, stage in enumerate(self.stages):
+            deps[stage.name] = set(stage.after)
+
+            for earlier in self.stages[:i]:
+                if earlier.writes & (stage.reads | stage.writes) or earlier.reads & stage.writes:
+                    deps[stage.name].add(earlier.name)
+
+        return deps
+
+    # Run all stages, with at most the given number of stages at the same
+    # time. If 'initWorker' is given, it is called at the start of each
+    # process running a stage, for example for reopening files whose file
+    # position would otherwise be shared with the parent. Raises the
+    # exception of the first stage which failed, after the other running
+    # stages have finished; stages which depend on it are not run.
+    #
+    # When the stages run in parallel, each of them takes one job, and the
+    # parallel stages get the remaining jobs. When they run one after the
+    # other, the parallel stages get all jobs.
+    def run(self, jobs = 1, initWorker = None):
+        if jobs <= 1 or len(self.stages) <= 1 or "fork" not in multiprocessing.get_all_start_methods():
+            self._runSequentially(jobs)
+        else:
+            self._runInParallel(jobs, initWorker)
+
+    # Print the running times of the stages, and the total time of the run
+    # given in seconds.
+    def printTimes(self, total):
+        print("Stage times:")
+
+        for stage in self.stages:
+            if stage.name in self.times:
+                print("  %-12s %7.2fs" % (stage.name, self.times[stage.name]))
+
+        print("  %-12s %7.2fs" % ("total", total))
+
+    # Run all stages in the current process, in the order they were added.
+    def _runSequentially(self, jobs):
+        for stage in self.stages:
+            start = time.perf_counter()
+            result = stage.call(jobs)
+            self.times[stage.name] = time.perf_counter() - start
+
+            if stage.done is not None:
+                stage.done(result)
+
+    # Run the stages in child processes.
+    def _runInParallel(self, jobs, initWorker):
+        deps = self.getDependencies()
+        context = multiprocessing.get_context("fork")
+
+        # Jobs left over for the parallel stages when all other stages are
+        # running at the same time
+        numParallel = sum(1 for stage in self.stages if stage.parallel)
+        stageJobs = max(1, (jobs - len(self.stages) + numParallel) // max(1, numParallel))
+
+        pending = list(self.stages)
+        running = {}  # connection to stage process -> (stage, process)
+        finished = set()
+        error = None
+
+        while pending or running:
+
+            # Start the stages whose dependencies have finished
+            if error is None:
+                for stage in list(pending):
+                    if len(running) >= jobs:
+                        break
+
+                    if deps[stage.name] <= finished:
+                        pending.remove(stage)
+
+                        # Buffered output would otherwise be duplicated by
+                        # the child process
+                        sys.stdout.flush()
+                        sys.stderr.flush()
+
+                        receiver, sender = context.Pipe(False)
+                        process = context.Process(target = _runStageInWorker, args = (stage, stageJobs, initWorker, sender), name = stage.name)
+                        process.start()
+                        sender.close()
+
+                        running[receiver] = (stage, process)
+
+            if not running:
+                break
+
+            # Wait for a stage to finish
+            for receiver in multiprocessing.connection.wait(list(running.keys())):
+                stage, process = running.pop(receiver)
+
+                try:
+                    e, result, elapsed = receiver.recv()
+                except EOFError:
+                    e, result, elapsed = EnvironmentError("Stage '%s' terminated unexpectedly" % stage.name), None, None
+
+                receiver.close()
+                process.join()
+
+                if elapsed is not None:
+                    self.times[stage.name] = elapsed
+
+                if e is not None:
+                    if error is None:
+                        error = e
+                    continue
+
+                finished.add(stage.name)
+
+                if stage.done is not None:
+                    stage.done(result)
+
+        if error is not None:
+            raise error
+
+
+# Main function of a process running a stage, which may use the given
+# number of jobs. Sends the tuple (exception, result, elapsed time) to the
+# parent, where the exception is None if the stage was successful.
+def _runStageInWorker(stage, jobs, initWorker, sender):
+    start = time.perf_counter()
+    error = None
+    result = None
+
+    # Write whole lines, so the output of stages running at the same time
+    # is not mixed within a line
+    sys.stdout.reconfigure(line_buffering = True)
+
+    try:
+        if initWorker is not None:
+            initWorker()
+
+        result = stage.call(jobs)
+    except Exception as e:
+        error = e
+
+    elapsed = time.perf_counter() - start
+
+    try:
+        sender.send((error, result, elapsed))
+    except Exception as e:
+
+        # The exception or the result can not be pickled
+        sender.send((EnvironmentError(str(error or e)), None, elapsed))
+
+    sender.close()
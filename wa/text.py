@@ -10,10 +10,14 @@
 # copyright notice and this permission notice appear in all copies.
 #
 
+import codecs
+import functools
 import re
 import zlib
 
 from .version import Version, isJapanese
+from .data import kanjiFontOffset
+from .glyph import GlyphIndex
 
 
 # Text control codes
@@ -464,27 +468,191 @@ kanjiByHash = {
 }
 
 
-# Decode text from the Japanese game version.
-def decodeJP(data, kanjiBitmap):
-    text = ""
+# Size of a Kanji character bitmap in the map data (11 lines of 16 bits,
+# 12 of which are used)
+kanjiCharSize = 22
+
+# Global atlas of the Kanji character bitmaps of all maps, mapping the bitmap
+# data to the unicode character (or None if the character is unknown). The
+# same characters appear in many maps, so each distinct bitmap only has to
+# be hashed and looked up once.
+_kanjiAtlas = {}
+
+
+# Reference index of known Kanji glyphs for finding the closest match of
+# unknown map-specific Kanji characters. It holds the Kanji font of the
+# executable (see addKanjiFont()) and the glyphs of all maps which are known
+# via their hash (see addKanjiGlyphs()). The index must be complete before
+# any map text is decoded, so the result of a match does not depend on the
+# order in which the maps are processed.
+kanjiIndex = GlyphIndex()
+
+# Unknown Kanji characters whose closest known glyph differs in at most
+# this many pixels are resolved automatically
+kanjiMatchDistance = 2
+
+
+# Add the Kanji font of the main executable to the index of known glyphs.
+def addKanjiFont(execData, version):
+    offset = kanjiFontOffset(version)
+    if offset is not None:
+        kanjiIndex.addFont(execData, kanji1 + kanji2, offset)
+        _kanjiIndexChanged()
+
+
+# Add the glyphs of a map's Kanji bitmap which are known via their hash to
+# the index of known glyphs.
+def addKanjiGlyphs(kanjiBitmap):
+    for offset in range(0, len(kanjiBitmap) - kanjiCharSize + 1, kanjiCharSize):
+        glyph = bytes(kanjiBitmap[offset:offset + kanjiCharSize])
+
+        t = kanjiByHash.get(zlib.crc32(glyph) & 0xffffffff)
+        if t is not None:
+            kanjiIndex.add(glyph, t)
+
+    _kanjiIndexChanged()
+
 
-    largeFont = False
+# Forget all resolved Kanji characters after the index of known glyphs was
+# changed, as characters which were matched against the old index might be
+# matched differently now.
+def _kanjiIndexChanged():
+    _kanjiAtlas.clear()
+    _getKanjiTableCached.cache_clear()
+
+
+# Print the bitmap of an unknown Kanji character.
+def _printKanji(glyph):
+    for y in range(11):
+        v = (glyph[y*2] << 8) | glyph[y*2 + 1]
+        s = ""
+        for x in range(16):
+            if v & 0x8000:
+                s += "#"
+            else:
+                s += "."
+            v <<= 1
+        print(s)
+    print()
+
+
+# Look up a map-specific Kanji character via a hash of its bitmap, returning
+# the unicode character or None if it is unknown.
+def _resolveKanji(glyph, c, c2):
+    try:
+        return _kanjiAtlas[glyph]
+    except KeyError:
+        pass
+
+    hash = zlib.crc32(glyph) & 0xffffffff
+
+    t = kanjiByHash.get(hash)
+
+    if t is None:
+
+        # Unknown character, look for the closest known glyphs
+        matches = kanjiIndex.search(glyph)
+
+        if matches and matches[0].distance <= kanjiMatchDistance:
+            m = matches[0]
+            t = m.char
+            print("Kanji %02x %02x (hash 0x%08x) matched as '%s' (distance %d, confidence %d%%)" % (c, c2, hash, t, m.distance, m.confidence * 100))
+
+        else:
+            print("Unknown Kanji %02x %02x" % (c, c2))
+            print("Hash = 0x%08x" % hash)
+            _printKanji(glyph)
+
+            if matches:
+                print("Closest matches: " + ", ".join("'%s' (distance %d, confidence %d%%)" % (m.char, m.distance, m.confidence * 100) for m in matches))
+                print()
+
+    _kanjiAtlas[glyph] = t
+    return t
+
+
+# Object representing the Kanji character table of a map. The characters
+# are resolved from the map's Kanji bitmap on first use, and then looked up
+# in constant time.
+class KanjiTable:
+
+    # Create a KanjiTable object from the Kanji bitmap data of a map.
+    def __init__(self, kanjiBitmap):
+        self.bitmap = bytes(kanjiBitmap)
+        self.numChars = len(self.bitmap) // kanjiCharSize
+
+        # Resolved characters, indexed by character number (False = not
+        # resolved yet, None = unknown)
+        self.chars = [False] * self.numChars
+
+    # Return the unicode character for the Kanji code (c, c2), or None if
+    # it is unknown.
+    def lookup(self, c, c2):
+        index = (c - 0x88) * 0xfd + c2 - 1
+
+        if index < 0 or index >= self.numChars:
+            return None
+
+        t = self.chars[index]
+        if t is False:
+            offset = index * kanjiCharSize
+            t = _resolveKanji(self.bitmap[offset:offset + kanjiCharSize], c, c2)
+            self.chars[index] = t
+
+        return t
+
+
+# Return a KanjiTable object for the given Kanji bitmap data (or the table
+# itself if it already is one).
+def getKanjiTable(kanjiBitmap):
+    if kanjiBitmap is None or isinstance(kanjiBitmap, KanjiTable):
+        return kanjiBitmap
+    else:
+        return _getKanjiTableCached(bytes(kanjiBitmap))
+
+@functools.lru_cache(maxsize = 16)
+def _getKanjiTableCached(kanjiBitmap):
+    return KanjiTable(kanjiBitmap)
+
+
+# Decode text from the Japanese game version. The 'kanjiTable' is the
+# KanjiTable of the map the text belongs to, or None for text outside of
+# maps.
+def decodeJP(data, kanjiTable):
+    return _decodeJP(data, kanjiTable)[0]
+
+
+# Decode Japanese text, returning the tuple (text, consumed, largeFont).
+# In 'stream' mode, null bytes are decoded to U+0000 instead of ending the
+# string. If 'final' is False, an incomplete character or control code at
+# the end of the data is left unconsumed. 'largeFont' is the font state at
+# the start of the data.
+def _decodeJP(data, kanjiTable, stream = False, final = True, largeFont = False):
+    text = ""
 
     dataSize = len(data)
 
     i = 0
     while i < dataSize:
+        start = i
         c = data[i]
         i += 1
 
         if c == 0x00:
 
             # End of string
-            break
+            if not stream:
+                break
+
+            text += "\0"
 
         elif c > 0x00 and c <= 0x1f:
 
             # Control code
+            if not final and i + controlCodes[c][0] > dataSize:
+                i = start
+                break
+
             code, i = decodeControl(c, data, i)
             text += code
 
@@ -499,66 +667,49 @@ def decodeJP(data, kanjiBitmap):
             sjis = bytes([0x82, c + 0x77])
             text += sjis.decode("sjis")
 
-        elif c >= 0x81 and c <= 0x84:
-
-            # SJIS double-byte code
-            sjis = bytes([c, data[i]])
-            i += 1
-            text += sjis.decode("sjis")
+        elif (c >= 0x81 and c <= 0x84) or (c >= 0x88 and c <= 0x9f):
 
-        elif (c >= 0x88 and c <= 0x9f):
+            # Double-byte code
+            if not final and i >= dataSize:
+                i = start
+                break
 
-            # Kanji
             c2 = data[i]
             i += 1
 
-            found = False
+            if c <= 0x84:
+
+                # SJIS double-byte code
+                sjis = bytes([c, c2])
+                text += sjis.decode("sjis")
+                continue
+
+            # Kanji
+            t = None
 
             if largeFont:
 
                 # The large (PSX ROM) font uses standard SJIS encoding
                 sjis = bytes([c, c2])
-                text += sjis.decode("sjis")
-                found = True
+                t = sjis.decode("sjis")
 
-            elif kanjiBitmap is None:
+            elif kanjiTable is None:
 
                 # Look up in global Kanji list
                 if c == 0x88:
-                    text += kanji1[c2 - 1]
-                    found = True
+                    t = kanji1[c2 - 1]
                 elif c == 0x89:
-                    text += kanji2[c2 - 1]
-                    found = True
+                    t = kanji2[c2 - 1]
 
             else:
 
-                # Map-specific Kanji, look up via a hash of the character image
-                offset = ((c - 0x88) * 0xfd + c2 - 1) * 22
-
-                if offset <= len(kanjiBitmap) - 22:
-                    hash = zlib.crc32(kanjiBitmap[offset:offset + 22]) & 0xffffffff
-
-                    try:
-                        text += kanjiByHash[hash]
-                        found = True
-                    except KeyError:
-                        print("Unknown Kanji %02x %02x" % (c, c2))
-                        print("Hash = 0x%08x" % hash)
-                        for y in range(11):
-                            v = (kanjiBitmap[offset + y*2] << 8) | kanjiBitmap[offset + y*2 + 1]
-                            s = ""
-                            for x in range(16):
-                                if v & 0x8000:
-                                    s += "#"
-                                else:
-                                    s += "."
-                                v <<= 1
-                            print(s)
-                        print()
-
-            if not found:
-                text += '{KANJI %02x %02x}' % (c, c2)
+                # Map-specific Kanji, look up via the map's Kanji table
+                t = kanjiTable.lookup(c, c2)
+
+            if t is None:
+                t = '{KANJI %02x %02x}' % (c, c2)
+
+            text += t
 
         elif c >= 0xa7 and c <= 0xdd:
 
@@ -570,7 +721,7 @@ def decodeJP(data, kanjiBitmap):
             # Unknown
             text += '{' + hex(c) + '}'
 
-    return text
+    return text, i, largeFont
 
 
 # International character set (variation of DOS code page 437)
@@ -614,8 +765,11 @@ altCharset = (
     "▯±…▯▯▯÷▯°∙▯▯▯▯▯▯"   # f0..ff
 )
 
+# Default character set used by the module-level functions
 charset = origCharset
 
+# Select the alternative character set as the default for the module-level
+# functions. Codec objects are not affected by this.
 def setAltCharset():
     global charset
     charset = altCharset
@@ -624,130 +778,483 @@ def setAltCharset():
 escapeChars = "\\{}"
 
 
-# Decode text from the US or European game version.
+# Build the 256-entry table for decoding international text with the given
+# character set. Printable characters map to their (escaped) unicode string,
+# control codes map to an (argLen, prefix) tuple.
+def _makeDecodeTable(charset):
+    table = []
+
+    for c in range(0x20):
+        argLen, code = controlCodes[c]
+        if argLen > 0:
+            table.append((argLen, '{' + code + ' '))
+        else:
+            table.append((0, '{' + code + '}'))
+
+    for t in charset:
+        if t in escapeChars:
+            table.append("\\" + t)
+        else:
+            table.append(t)
+
+    return table
+
+# Build the table for encoding international text with the given character
+# set, suitable for str.translate(). Unicode characters map to their byte
+# code (as a one-character string), with the first occurrence winning for
+# characters which appear more than once in the character set.
+def _makeEncodeTable(charset):
+    table = {}
+
+    for i, t in enumerate(charset):
+        table.setdefault(ord(t), chr(i + 0x20))
+
+    return table
+
+# Build a pattern which matches any character not contained in the given
+# character set.
+def _makeInvalidPattern(charset):
+    return re.compile("[^" + re.escape("".join(sorted(set(charset)))) + "]")
+
+
+# Pattern matching the control codes and the terminating null byte
+_controlPattern = re.compile(rb"[\x00-\x1f]")
+
+
+# Decode text from the US or European game version, using the default
+# character set.
 def decodeINT(data):
-    text = ""
+    return getCodec(Version.US).decode(data)
+
 
+# Decode international text with the given decode table, returning the
+# tuple (text, consumed). 'stream' and 'final' have the same meaning as for
+# _decodeJP().
+#
+# Runs of printable characters are translated in one step via the decode
+# table, so the Python-level work is proportional to the number of control
+# codes in the string, not to the number of characters.
+def _decodeINT(data, table, stream = False, final = True):
+    search = _controlPattern.search
     dataSize = len(data)
 
+    parts = []
+
     i = 0
-    while i < dataSize:
-        c = data[i]
-        i += 1
+    while True:
+        m = search(data, i)
+        end = dataSize if m is None else m.start()
+
+        if end > i:
 
+            # Regular characters (note: only the EU versions use characters >= 0x80;
+            # the US version uses 7-bit ASCII, with some exceptions)
+            parts.append(data[i:end].decode("latin-1").translate(table))
+
+        if m is None:
+            i = max(i, dataSize)
+            break
+
+        c = data[end]
         if c == 0x00:
 
             # End of string
+            if not stream:
+                i = end
+                break
+
+            parts.append("\0")
+            i = end + 1
+            continue
+
+        # Control code
+        argLen, code = table[c]
+
+        if not final and end + 1 + argLen > dataSize:
+            i = end
             break
 
-        elif c > 0x00 and c <= 0x1f:
+        i = end + 1
 
-            # Control code
-            code, i = decodeControl(c, data, i)
+        if argLen > 0:
+            code += data[i:i + argLen].decode("ascii") + '}'
+            i += argLen
 
-            text += code
+        parts.append(code)
 
-        else:
+    return "".join(parts), i
 
-            # Regular character (note: only the EU versions use characters >= 0x80;
-            # the US version uses 7-bit ASCII, with some exceptions)
-            t = charset[c - 0x20]
 
-            if t in escapeChars:
-                text += "\\"
+# Pattern for splitting a string into escape sequences, command sequences,
+# and runs of regular printable characters
+_tokenPattern = re.compile(r"\\(.)?|\{([^}]*)(\})?|[^\\{]+", re.DOTALL)
 
-            text += t
+# Pattern for parsing a command sequence into keyword and argument
+_commandPattern = re.compile(r"(\S+)(?: (\d+))?")
 
-    return text
+# Cache of encoded command sequences
+_commandCache = {}
 
 
-# Decode Wild Arms text string to unicode string.
-def decode(data, version, kanjiBitmap = None):
-    if isJapanese(version):
-        return decodeJP(data, kanjiBitmap)
-    else:
-        return decodeINT(data)
+# Encode a command sequence (the text between the braces) to a control code
+# and its argument.
+def _encodeCommand(command, text):
+    try:
+        return _commandCache[command]
+    except KeyError:
+        pass
 
+    m = _commandPattern.match(command)
+    if not m:
+        raise ValueError("Syntax error in command '%s' in string '%s'" % (command, text))
+
+    keyword = m.group(1)
+
+    # Find the command code
+    try:
+        code = codeOfCommand[keyword]
+    except KeyError:
+        raise ValueError("Unknown command '%s' in string '%s'" % (keyword, text))
+
+    data = bytes([code])
+
+    # Get the argument
+    argLen = controlCodes[code][0]
+
+    if argLen:
+        if m.group(2) is None:
+            raise ValueError("Syntax error in command '%s' in string '%s'" % (command, text))
+
+        arg = int(m.group(2))
+        if arg >= 10**argLen:
+            raise ValueError("Argument of %s command out of range in string '%s'" % (keyword, text))
+
+        data += b"%0*d" % (argLen, arg)
+
+    _commandCache[command] = data
+    return data
 
-# Encode unicode string to Wild Arms text string.
-def encode(text, version):
-    if isJapanese(version):
-        raise EnvironmentError("Japanese text encoding is not supported")
 
-    textSize = len(text)
+# Encode international text with the given encode table, returning the tuple
+# (data, consumed). The data is not null-terminated. 'invalid' is the pattern
+# matching unencodable characters. If 'final' is False, an incomplete escape
+# or command sequence at the end of the text is left unconsumed.
+def _encodeINT(text, table, invalid, final = True):
     data = bytearray()
+    consumed = len(text)
 
-    i = 0
-    while i < textSize:
-        c = text[i]
-        i += 1
+    for m in _tokenPattern.finditer(text):
+        c = text[m.start()]
 
         if c == '\\':
 
             # Escape sequence
-            if i >= textSize:
-                raise IndexError("Spurious '\\' at end of string '%s'" % text)
+            c = m.group(1)
+            if c is None:
+                if not final:
+                    consumed = m.start()
+                    break
 
-            c = text[i]
-            i += 1
+                raise IndexError("Spurious '\\' at end of string '%s'" % text)
 
-            if c in escapeChars:
-                data.append(charset.index(c) + 0x20)
-            else:
+            if c not in escapeChars:
                 raise ValueError("Unknown escape sequence '\\%s' in string '%s'" % (c, text))
 
+            try:
+                data.append(ord(table[ord(c)]))
+            except KeyError:
+                raise ValueError("Unencodable character '%s' in string '%s'" % (c, text))
+
         elif c == '{':
 
             # Command sequence
-            end = text.find('}', i)
-            if end == -1:
+            if m.group(3) is None:
+                if not final:
+                    consumed = m.start()
+                    break
+
                 raise IndexError("Mismatched {} in string '%s'" % text)
 
-            command = text[i:end]
-            keyword = command.split()[0]
-            i = end + 1
+            data += _encodeCommand(m.group(2), text)
 
-            # Find the command code
-            try:
-                code = codeOfCommand[keyword]
-            except KeyError:
-                raise ValueError("Unknown command '%s' in string '%s'" % (keyword, text))
+        else:
+
+            # Run of regular printable characters
+            run = m.group()
+
+            bad = invalid.search(run)
+            if bad:
+                raise ValueError("Unencodable character '%s' in string '%s'" % (bad.group(), text))
+
+            data += run.translate(table).encode("latin-1")
 
-            data.append(code)
+    return data, consumed
 
 
-            # Get the argument
-            arg = None
-            argLen = controlCodes[code][0]
+# Names of the game versions as used in Python codec names
+_versionNames = {
+    Version.JP1: "jp1",
+    Version.JP2: "jp2",
+    Version.US:  "us",
+    Version.EN:  "en",
+    Version.FR:  "fr",
+    Version.DE:  "de",
+    Version.IT:  "it",
+    Version.ES:  "es",
+}
+
+
+# Object representing the text encoding of a game version with a given
+# character set. A Codec holds all tables needed for decoding and encoding,
+# so different versions and character sets can be used side by side and
+# from multiple threads.
+#
+# Codecs for the standard character sets are also available through the
+# Python codec registry under the names "wildarms_<version>" and
+# "wildarms_<version>_alt" (e.g. "wildarms_us", "wildarms_de_alt"). The
+# registered codecs treat null bytes as regular characters (U+0000) instead
+# of string terminators, so that streams of strings can be processed, and
+# support incremental encoding and decoding.
+class Codec:
+
+    # Create a Codec object for the given game version and character set
+    # (the character set is ignored for the Japanese version).
+    def __init__(self, version, charset = origCharset):
+        self.version = version
+        self.charset = charset
+
+        if isJapanese(version):
+            self.decodeTable = None
+            self.encodeTable = None
+            self.invalidPattern = None
+        else:
+            self.decodeTable = _makeDecodeTable(charset)
+            self.encodeTable = _makeEncodeTable(charset)
 
-            if argLen:
-                m = re.match(keyword + r" (\d+)", command)
-                arg = int(m.group(1))
+            # The US version only supports the 7-bit part of the character set
+            if version == Version.US:
+                self.invalidPattern = _makeInvalidPattern(charset[:0x60])
             else:
-                m = re.match(keyword, command)
+                self.invalidPattern = _makeInvalidPattern(charset)
+
+        # Name in the Python codec registry
+        self.name = "wildarms_" + _versionNames[version]
+        if charset == altCharset and not isJapanese(version):
+            self.name += "_alt"
 
-            if not m:
-                raise ValueError("Syntax error in command '%s' in string '%s'" % (command, text))
+    def __eq__(self, other):
+        return isinstance(other, Codec) and (self.version, self.charset) == (other.version, other.charset)
 
-            if argLen:
-                if arg < 0 or arg >= 10**argLen:
-                    raise "Argument of %s command out of range in string '%s'" % (keyword, text)
+    def __hash__(self):
+        return hash((self.version, self.charset))
 
-                data.extend((b"%%0%dd" % argLen) % arg)
+    def __repr__(self):
+        return "<wa.text.Codec %s>" % self.name
 
+    # Decode Wild Arms text string to unicode string. The 'kanjiTable' (a
+    # KanjiTable object, or the raw Kanji bitmap data) is only used for the
+    # Japanese version.
+    def decode(self, data, kanjiTable = None):
+        data = bytes(data)
+
+        if self.decodeTable is None:
+            return _decodeJP(data, getKanjiTable(kanjiTable))[0]
         else:
+            return _decodeINT(data, self.decodeTable)[0]
 
-            # Regular printable character
-            try:
-                t = charset.index(c) + 0x20
-                data.append(t)
+    # Encode unicode string to Wild Arms text string.
+    def encode(self, text):
+        if self.encodeTable is None:
+            raise EnvironmentError("Japanese text encoding is not supported")
 
-                if (version == Version.US) and (t >= 0x80):
-                    raise ValueError
+        data, consumed = _encodeINT(text, self.encodeTable, self.invalidPattern)
 
-            except ValueError:
-                raise ValueError("Unencodable character '%s' in string '%s'" % (c, text))
+        # Terminate string
+        data.append(0)
+        return data
 
-    # Terminate string
-    data.append(0)
-    return data
+    # Decode a list of Wild Arms text strings to a list of unicode strings.
+    # Game text is very repetitive, so duplicate strings are only decoded
+    # once, and results are kept in an LRU cache across calls.
+    def decodeMany(self, strings, kanjiTable = None):
+        if self.decodeTable is None:
+            kanjiTable = getKanjiTable(kanjiTable)
+        else:
+            kanjiTable = None
+
+        strings = [bytes(s) for s in strings]
+        decoded = {s: _decodeCached(self, s, kanjiTable) for s in dict.fromkeys(strings)}
+
+        return [decoded[s] for s in strings]
+
+    # Encode a list of unicode strings to a list of Wild Arms text strings.
+    # Like decodeMany(), duplicate strings are only encoded once. Each
+    # returned string is a separate bytearray which may be modified by the
+    # caller.
+    def encodeMany(self, texts):
+        encoded = {t: _encodeCached(self, t) for t in dict.fromkeys(texts)}
+
+        return [bytearray(encoded[t]) for t in texts]
+
+    # Decode a stream of Wild Arms text, returning the tuple (text, consumed,
+    # largeFont). Null bytes are decoded to U+0000. If 'final' is False, an
+    # incomplete character at the end of the data is left unconsumed.
+    def decodeStream(self, data, final = True, largeFont = False):
+        data = bytes(data)
+
+        if self.decodeTable is None:
+            return _decodeJP(data, None, True, final, largeFont)
+        else:
+            text, consumed = _decodeINT(data, self.decodeTable, True, final)
+            return text, consumed, largeFont
+
+    # Encode a stream of unicode text, returning the tuple (data, consumed).
+    # U+0000 characters are encoded to null bytes. If 'final' is False, an
+    # incomplete escape or command sequence at the end of the text is left
+    # unconsumed.
+    def encodeStream(self, text, final = True):
+        if self.encodeTable is None:
+            raise EnvironmentError("Japanese text encoding is not supported")
+
+        data = bytearray()
+        consumed = 0
+
+        strings = text.split("\0")
+        for i, string in enumerate(strings):
+            last = (i == len(strings) - 1)
+
+            d, c = _encodeINT(string, self.encodeTable, self.invalidPattern, final or not last)
+            data += d
+            consumed += c
+
+            if not last:
+                data.append(0)
+                consumed += 1
+
+        return bytes(data), consumed
+
+    # Return a codecs.CodecInfo object for registering the codec with the
+    # Python codec registry.
+    def getCodecInfo(self):
+        return codecs.CodecInfo(
+            name = self.name,
+            encode = lambda input, errors = "strict": self.encodeStream(input),
+            decode = lambda input, errors = "strict": self.decodeStream(input)[:2],
+            incrementalencoder = type("IncrementalEncoder", (_IncrementalEncoder,), {"codec": self}),
+            incrementaldecoder = type("IncrementalDecoder", (_IncrementalDecoder,), {"codec": self}),
+        )
+
+
+# Incremental encoder for the Python codec interface. Only strict error
+# handling is supported.
+class _IncrementalEncoder(codecs.BufferedIncrementalEncoder):
+    codec = None
+
+    def _buffer_encode(self, input, errors, final):
+        return self.codec.encodeStream(input, final)
+
+
+# Incremental decoder for the Python codec interface, which keeps track of
+# the font selection for the Japanese version. Only strict error handling is
+# supported.
+class _IncrementalDecoder(codecs.BufferedIncrementalDecoder):
+    codec = None
+
+    def __init__(self, errors = "strict"):
+        codecs.BufferedIncrementalDecoder.__init__(self, errors)
+        self.largeFont = False
+
+    def _buffer_decode(self, input, errors, final):
+        text, consumed, self.largeFont = self.codec.decodeStream(input, final, self.largeFont)
+        return text, consumed
+
+    def reset(self):
+        codecs.BufferedIncrementalDecoder.reset(self)
+        self.largeFont = False
+
+    def getstate(self):
+        return (self.buffer, int(self.largeFont))
+
+    def setstate(self, state):
+        self.buffer = state[0]
+        self.largeFont = bool(state[1])
+
+
+# Cache of Codec objects, indexed by (version, charset)
+_codecCache = {}
+
+
+# Return the Codec object for the given game version and character set
+# (None = the default set by setAltCharset()).
+def getCodec(version, characterSet = None):
+    if characterSet is None:
+        characterSet = charset
+
+    key = (version, characterSet)
+
+    try:
+        return _codecCache[key]
+    except KeyError:
+        return _codecCache.setdefault(key, Codec(version, characterSet))
+
+
+# Search function for the Python codec registry.
+def _searchCodec(name):
+    if not name.startswith("wildarms_"):
+        return None
+
+    name = name[len("wildarms_"):]
+
+    charset = origCharset
+    if name.endswith("_alt"):
+        charset = altCharset
+        name = name[:-len("_alt")]
+
+    for version, versionName in _versionNames.items():
+        if name == versionName:
+            return getCodec(version, charset).getCodecInfo()
+
+    return None
+
+codecs.register(_searchCodec)
+
+
+# Decode Wild Arms text string to unicode string, using the default
+# character set. The 'kanjiTable' (a KanjiTable object, or the raw Kanji
+# bitmap data) is only used for the Japanese version.
+def decode(data, version, kanjiTable = None):
+    return getCodec(version).decode(data, kanjiTable)
+
+
+# Encode unicode string to Wild Arms text string, using the default
+# character set.
+def encode(text, version):
+    return getCodec(version).encode(text)
+
+
+# Maximum number of strings kept in the decodeMany()/encodeMany() caches
+cacheSize = 16384
+
+
+# Cached single-string decoding.
+@functools.lru_cache(maxsize = cacheSize)
+def _decodeCached(codec, data, kanjiTable):
+    return codec.decode(data, kanjiTable)
+
+
+# Cached single-string encoding, returning an immutable byte string.
+@functools.lru_cache(maxsize = cacheSize)
+def _encodeCached(codec, text):
+    return bytes(codec.encode(text))
+
+
+# Decode a list of Wild Arms text strings to a list of unicode strings,
+# using the default character set (see Codec.decodeMany()).
+def decodeMany(strings, version, kanjiTable = None):
+    return getCodec(version).decodeMany(strings, kanjiTable)
+
+
+# Encode a list of unicode strings to a list of Wild Arms text strings,
+# using the default character set (see Codec.encodeMany()).
+def encodeMany(texts, version):
+    return getCodec(version).encodeMany(texts)